@@ -2,6 +2,7 @@ from .cli_utils import *
 from .lmdb_utils import *
 from .logging_utils import *
 from .misc_utils import *
+from .file_utils import *
 from .progress_utils import *
 from .time_utils import *
 from .metric_utils import *
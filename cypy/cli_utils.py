@@ -1,5 +1,14 @@
+import os
+import sys
+import pickle
+import hashlib
 import argparse
+import random
+import itertools
+from collections import ChainMap
+from collections.abc import Mapping
 from cypy.misc_utils import LazyImport, warn_print
+from cypy.file_utils import atomic_write
 
 # on some machines, install OmegaConf is not easy
 # from omegaconf import OmegaConf
@@ -43,16 +52,182 @@ def simple_cli(to_dict=False, **kwargs):
     return args if not to_dict else vars(args)
 
 
-def get_params(to_dict=False, config=None, **new_kwargs):
+class LazyConfig(object):
+    """Attribute / item view of a resolved config dict. Reads and writes are plain dict operations, no OmegaConf involved.
+    `cfg.omegaconf` builds a `omegaconf.DictConfig` snapshot on demand (rebuilt after writes), changes made on that
+    snapshot are not written back. `merge_with` is the only OmegaConf method supported on the view, and it writes back.
+
+    e.g.:
+    cfg = get_params(cache_dir='/tmp/cfg_cache', lazy=True)
+    cfg.model.lr  # no OmegaConf involved
+    print(omegaconf.OmegaConf.to_yaml(cfg.omegaconf))
+    """
+
+    def __init__(self, data, root=None):
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_root', root)
+        object.__setattr__(self, '_omegaconf', None)
+
+    def _wrap(self, key, value):
+        if isinstance(value, Mapping):
+            if isinstance(self._data, ChainMap) and key not in self._data.maps[0]:
+                # copy-on-write overlay (see `iter_sweep_params`), writes must not reach the shared base config
+                value = ChainMap({}, value)
+                self._data.maps[0][key] = value
+            return LazyConfig(value, root=self._root or self)
+        return value
+
+    def _invalidate(self):
+        object.__setattr__(self._root or self, '_omegaconf', None)
+        object.__setattr__(self, '_omegaconf', None)
+
+    @property
+    def omegaconf(self):
+        if self._omegaconf is None:
+            object.__setattr__(self, '_omegaconf', omegaconf.OmegaConf.create(self.to_dict()))
+        return self._omegaconf
+
+    def to_dict(self):
+        # a plain nested dict copy, overlays (ChainMap) are flattened
+        def to_plain(value):
+            if isinstance(value, Mapping):
+                return {k: to_plain(v) for k, v in value.items()}
+            if isinstance(value, list):
+                return [to_plain(v) for v in value]
+            return value
+        return to_plain(self._data)
+
+    def __getattr__(self, name):
+        data = object.__getattribute__(self, '_data')
+        if name in data:
+            return self._wrap(name, data[name])
+        # missing keys, and OmegaConf methods which would only change the snapshot, are not forwarded
+        raise AttributeError(f'Missing key {name} in the config. For the OmegaConf API, use `cfg.omegaconf` '
+                             f'(a snapshot, changes are not written back) or `cfg.merge_with`.')
+
+    def merge_with(self, *others):
+        # same as DictConfig.merge_with, the merged (resolved) values are written back to this view
+        for other in others:
+            if isinstance(other, LazyConfig):
+                other = other.to_dict()
+            merged = omegaconf.OmegaConf.merge(self.to_dict(), other)
+            merged = omegaconf.OmegaConf.to_container(merged, resolve=True)
+            for key, value in merged.items():
+                self._data[key] = value
+        self._invalidate()
+
+    def __setattr__(self, name, value):
+        self._data[name] = value
+        self._invalidate()
+
+    def __getitem__(self, key):
+        return self._wrap(key, self._data[key])
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._invalidate()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return [self._wrap(k, self._data[k]) for k in self._data]
+
+    def items(self):
+        return [(k, self._wrap(k, self._data[k])) for k in self._data]
+
+    def get(self, key, default=None):
+        return self._wrap(key, self._data[key]) if key in self._data else default
+
+    def __eq__(self, other):
+        if isinstance(other, LazyConfig):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+def _config_cache_path(cache_dir, config_path, argv, new_kwargs):
+    # the key covers the config file content, the cmd args and new_kwargs
+    hasher = hashlib.sha1()
+    with open(config_path, 'rb') as f:
+        hasher.update(f.read())
+    hasher.update(repr((os.path.abspath(config_path), list(argv), sorted(new_kwargs.items(), key=lambda x: x[0]))).encode())
+    return os.path.join(cache_dir, f'cfg_{hasher.hexdigest()}.pkl')
+
+
+def get_params(to_dict=False, config=None, cache_dir=None, lazy=False, **new_kwargs):
     # priority: cmd args > new_kwargs > dict in config
     # `--config` in cmd args can overwrite `config`
+    # cache_dir: (or env `CYPY_CONFIG_CACHE_DIR`) cache the resolved config in a pickle keyed by the hash of the config
+    #   file + cmd args + new_kwargs, so that later calls (DataLoader workers, subprocesses, reruns) skip the argparse
+    #   building and the OmegaConf merges. The return type is the same on a cache hit and miss.
+    #   Do not use it with interpolations depending on the environment (e.g. `${oc.env:...}`), they are cached resolved.
+    # lazy: return a `LazyConfig` view of the resolved dict instead of a DictConfig (ignored if `to_dict`),
+    #   the DictConfig is then only built when `cfg.omegaconf` is accessed.
+    cache_dir = cache_dir or os.environ.get('CYPY_CONFIG_CACHE_DIR')
+    argv = sys.argv[1:]
+    cfg_dict = None
+    if cache_dir and '-h' not in argv and '--help' not in argv:
+        parser = _get_base_parser(config)
+        config_path = parser.parse_known_args()[0].config
+        cache_path = _config_cache_path(cache_dir, config_path, argv, new_kwargs) if os.path.isfile(config_path) else None
+        if cache_path and os.path.isfile(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    cfg_dict = pickle.load(f)
+            except Exception as e:
+                warn_print(f'failed to load the config cache [{cache_path}]: {e}, re-parse the config.')
+        if cfg_dict is None:
+            cfg_dict = omegaconf.OmegaConf.to_container(_parse_params(config, new_kwargs), resolve=True)
+            if cache_path:
+                os.makedirs(cache_dir, exist_ok=True)
+                with atomic_write(cache_path) as tmp_path:
+                    with open(tmp_path, 'wb') as f:
+                        pickle.dump(cfg_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        oc_cfg = _parse_params(config, new_kwargs)
+        # print(OmegaConf.to_yaml(oc_cfg))
+        if not to_dict and not lazy:
+            return oc_cfg
+        cfg_dict = omegaconf.OmegaConf.to_container(oc_cfg, resolve=True)
 
-    # (1) the base parser, introduce `config`
+    if to_dict:
+        return cfg_dict
+    if lazy:
+        return LazyConfig(cfg_dict)
+    return omegaconf.OmegaConf.create(cfg_dict)
+
+
+def _get_base_parser(config=None):
+    # the base parser, introduce `config`
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument('-c', '--config', type=str, default=config or 'cfg.yaml')
     parser.add_argument('--distributed', type=int, default=1)
     parser.add_argument('--local_rank', type=int, default=0)
     parser.add_argument('--world_size', type=int, default=1)
+    return parser
+
+
+def _parse_params(config, new_kwargs):
+    # (1) the base parser, introduce `config`
+    parser = _get_base_parser(config)
     # parse the above cmd options
     args_tmp = parser.parse_known_args()[0]
     args_tmp_dict = vars(args_tmp)
@@ -101,9 +276,88 @@ def get_params(to_dict=False, config=None, **new_kwargs):
         nested_set(oc_cfg_dict, sub_ks, v)
 
     oc_cfg.merge_with(oc_cfg_dict)
-
-    # print(OmegaConf.to_yaml(oc_cfg))
-    if to_dict:
-        return omegaconf.OmegaConf.to_container(oc_cfg, resolve=True)
     return oc_cfg
 
+
+def expand_grid(grid, mode='cartesian', num_samples=None, seed=0):
+    """Generate the override dicts of a sweep, e.g. {'model.lr': 0.1, 'batch_size': 32}.
+
+    Args:
+        grid (dict): dotted key -> list of values. In 'random' mode, a value can also be a callable taking a
+            `random.Random` and returning a sampled value, e.g. lambda rng: 10 ** rng.uniform(-4, -2).
+        mode (str): 'cartesian' (all the combinations, in order) or 'random' (each key sampled independently).
+        num_samples (int || None): number of override dicts, required by 'random'. For 'cartesian', None means all.
+        seed (int): seed of 'random'. Defaults to 0.
+    """
+    assert mode in ['cartesian', 'random'], f'mode must be cartesian or random, but got {mode}'
+    keys = list(grid)
+    if mode == 'cartesian':
+        for v in grid.values():
+            assert not callable(v), 'callable values are only supported in random mode'
+        combos = itertools.product(*[grid[k] for k in keys])
+        if num_samples is not None:
+            combos = itertools.islice(combos, num_samples)
+        for combo in combos:
+            yield dict(zip(keys, combo))
+    else:
+        assert num_samples is not None, 'num_samples is required in random mode'
+        rng = random.Random(seed)
+        for _ in range(num_samples):
+            yield {k: grid[k](rng) if callable(grid[k]) else rng.choice(grid[k]) for k in keys}
+
+
+def _overlay_plan(keys):
+    # dotted keys -> tree of {name: [full key if overridden here, sub plan]}, built once per sweep
+    plan = {}
+    for key in keys:
+        node = plan
+        names = key.split('.')
+        for i, name in enumerate(names):
+            entry = node.setdefault(name, [None, {}])
+            if i == len(names) - 1:
+                entry[0] = key
+            node = entry[1]
+    return plan
+
+
+def _apply_overlay_plan(base, plan, overrides):
+    top = {}
+    for name, (key, sub_plan) in plan.items():
+        value = overrides[key] if key is not None else base.get(name)
+        if sub_plan:
+            value = _apply_overlay_plan(value if isinstance(value, Mapping) else {}, sub_plan, overrides)
+        top[name] = value
+    return ChainMap(top, base)
+
+
+def overlay_config(base, overrides):
+    """Return a copy-on-write view of the nested dict `base` with the dotted-key `overrides` applied: only the dicts on
+    the overridden paths get a (ChainMap) overlay, the rest is shared with `base`, so it costs O(len(overrides)).
+    """
+    return _apply_overlay_plan(base, _overlay_plan(overrides), overrides)
+
+
+def iter_sweep_params(grid, mode='cartesian', num_samples=None, seed=0, with_overrides=False, to_dict=False,
+                      config=None, cache_dir=None, **new_kwargs):
+    """Parse the config once (same as `get_params`, including cmd args and `cache_dir`), then lazily yield one config
+    per point of the sweep, built as a copy-on-write overlay of the base config instead of re-parsing.
+
+    e.g.:
+    for overrides, cfg in iter_sweep_params({'model.lr': [0.1, 0.01], 'batch_size': [32, 64]}, with_overrides=True):
+        launch(cfg)
+
+    Args:
+        grid, mode, num_samples, seed: see `expand_grid`.
+        with_overrides (bool): yield (overrides, cfg) instead of cfg. Defaults to False.
+        to_dict (bool): yield plain nested dicts (a full copy per config) instead of `LazyConfig` views. Defaults to False.
+
+    NOTE: the base config is already resolved, so the overrides do not propagate to the interpolations depending on
+    them, same as the cmd args of `get_params`. Lists are shared with the base config, do not modify them in place.
+    """
+    base = get_params(to_dict=True, config=config, cache_dir=cache_dir, **new_kwargs)
+    plan = _overlay_plan(grid)
+    for overrides in expand_grid(grid, mode=mode, num_samples=num_samples, seed=seed):
+        cfg = LazyConfig(_apply_overlay_plan(base, plan, overrides))
+        if to_dict:
+            cfg = cfg.to_dict()
+        yield (overrides, cfg) if with_overrides else cfg
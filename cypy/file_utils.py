@@ -0,0 +1,148 @@
+import os
+import uuid
+import errno
+import shutil
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+FSYNC_POLICIES = ['none', 'file', 'full']
+
+
+def make_tmp_path(dst_path, tag='tmp'):
+    """Return a unique hidden tmp path in the same dir as `dst_path`, so that the final `os.replace` is an atomic
+    rename on the same filesystem instead of a cross-device copy.
+    The extension is kept (a.mp4 -> .a.mp4.<tag>.<uuid>.mp4), since tools like ffmpeg choose the muxer by extension.
+    """
+    dst_dir, dst_name = os.path.split(os.path.abspath(dst_path))
+    ext = os.path.splitext(dst_name)[-1]
+    return os.path.join(dst_dir, f'.{dst_name}.{tag}.{uuid.uuid4().hex[:12]}{ext}')
+
+
+def fsync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(dir_path):
+    # persist the rename itself, not supported on some platforms/filesystems
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _check_fsync(fsync):
+    fsync = fsync or 'none'
+    assert fsync in FSYNC_POLICIES, f'fsync must be one of {FSYNC_POLICIES}, but got {fsync}'
+    return fsync
+
+
+def atomic_replace(src_path, dst_path, fsync='none'):
+    """Move `src_path` to `dst_path` atomically, overwriting `dst_path` if exists.
+
+    Args:
+        fsync (str || None, optional):
+            'none': no fsync, fastest, the rename may be lost on power failure.
+            'file': fsync the file data before the rename, so `dst_path` is never a partially written file.
+            'full': 'file' + fsync the dst dir after the rename, so the rename itself is durable.
+            Defaults to 'none'.
+
+    If src and dst are on different filesystems, src is copied to a tmp file next to dst first, then renamed,
+    so dst is still replaced atomically.
+    """
+    fsync = _check_fsync(fsync)
+    if fsync in ['file', 'full']:
+        fsync_file(src_path)
+    try:
+        os.replace(src_path, dst_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tmp_path = make_tmp_path(dst_path)
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            if fsync in ['file', 'full']:
+                fsync_file(tmp_path)
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            safe_remove(tmp_path)
+            raise
+        os.remove(src_path)
+    if fsync == 'full':
+        fsync_dir(os.path.dirname(os.path.abspath(dst_path)))
+
+
+def safe_remove(path):
+    # remove a file (or a dir tree) without raising if it does not exist, return True if something is removed
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def atomic_write(dst_path, fsync='none', tag='tmp'):
+    """Yield a tmp path next to `dst_path`. When the block exits normally and the tmp file exists, it atomically replaces
+    `dst_path`. On exception, the tmp file is removed and `dst_path` is untouched.
+
+    e.g.:
+    with atomic_write('a.mp4') as tmp_path:
+        run_cmd(['ffmpeg', '-y', '-i', 'b.avi', tmp_path])
+    """
+    fsync = _check_fsync(fsync)
+    tmp_path = make_tmp_path(dst_path, tag=tag)
+    try:
+        yield tmp_path
+    except BaseException:
+        safe_remove(tmp_path)
+        raise
+    if os.path.exists(tmp_path):
+        atomic_replace(tmp_path, dst_path, fsync=fsync)
+
+
+def _run_bulk(func, items, workers):
+    # return a list of (item, exception or None) in the same order as items
+    def run(item):
+        try:
+            func(item)
+            return item, None
+        except Exception as e:
+            return item, e
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(run, items))
+    return [run(item) for item in items]
+
+
+def bulk_replace(pairs, fsync='none', workers=1):
+    """`atomic_replace` for many (src_path, dst_path) pairs.
+    With fsync='full', each dst dir is only fsynced once at the end instead of once per file.
+    Return a list of ((src_path, dst_path), exception or None).
+    """
+    fsync = _check_fsync(fsync)
+    file_fsync = 'file' if fsync == 'full' else fsync
+    results = _run_bulk(lambda pair: atomic_replace(pair[0], pair[1], fsync=file_fsync), list(pairs), workers)
+    if fsync == 'full':
+        for dst_dir in set(os.path.dirname(os.path.abspath(pair[1])) for pair, err in results if err is None):
+            fsync_dir(dst_dir)
+    return results
+
+
+def bulk_remove(paths, workers=1):
+    # `safe_remove` for many paths, return a list of (path, exception or None)
+    return _run_bulk(safe_remove, list(paths), workers)
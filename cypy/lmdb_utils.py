@@ -11,7 +11,7 @@ import queue
 import time
 
 from cypy.logging_utils import EasyLoggerManager
-from cypy.misc_utils import warning_prompt, warn_print, deprecated
+from cypy.misc_utils import warning_prompt, warn_print, deprecated, timed
 
 #TODO: more serialization methods like quickle (https://github.com/jcrist/quickle)
 
@@ -33,6 +33,7 @@ def open_db(db_path, write=False, map_size=1099511627776 * 2, readahead=True):
     return env
 
 
+@timed('lmdb.db_get')
 def db_get(env, sid, serialize=False, logger=None, suppress_error=False):
     if isinstance(sid, str):
         sid = sid.encode('utf-8')
@@ -65,6 +66,7 @@ def db_get(env, sid, serialize=False, logger=None, suppress_error=False):
     return item
 
 
+@timed('lmdb.batch_db_get')
 def batch_db_get(env, sids, serialize=False, logger=None, suppress_error=False):
     for i in range(len(sids)):
         if isinstance(sids[i], str):
@@ -8,9 +8,11 @@ import sys
 import traceback
 import time
 import datetime
+import signal
 from copy import deepcopy, copy
 from logging.handlers import BaseRotatingHandler
 import re
+import weakref
 
 original_print = print
 
@@ -450,7 +452,196 @@ class RotatingFileDateHandler(BaseRotatingHandler):
         os.rename(self.baseFilename, dst_file)
 
         self.stream = self._open()
-        
+
+
+class RingBufferHandler(logging.Handler):
+    # crash hooks are shared by all the ring buffers of the process, see `install_crash_hooks`
+    _hooks_lock = threading.Lock()
+    _crash_handlers = weakref.WeakSet()
+    _excepthooks_installed = False
+    _hooked_signals = set()
+
+    def __init__(self, capacity=10000, dump_path=None, level=logging.DEBUG):
+        """Keep the last `capacity` records in memory and dump them to file on demand.
+        Records are stored as compact tuples in a preallocated list, no formatting is done at emit time,
+        so the steady-state cost is only a tuple creation and an index increment.
+        The formatting is deferred to `dump`, which is usually called on crash (see `install_crash_hooks`)
+        or explicitly by the user.
+
+        Args:
+            capacity (int, optional):
+                How many records to keep. Older records are overwritten.
+                Defaults to 10000.
+            dump_path (str || None, optional):
+                Default file path to dump records to. If None, must be given in `dump`.
+                Defaults to None.
+            level (int || str, optional):
+                Handler level. Defaults to logging.DEBUG.
+        """
+        super().__init__(level)
+        assert isinstance(capacity, int) and capacity > 0, f'capacity must be int and > 0, but got {capacity}.'
+        self.capacity = capacity
+        self.dump_path = dump_path
+        self._buffer = [None] * capacity
+        self._index = 0
+        self._count = 0
+
+    def emit(self, record):
+        # NOTE: `logging.Handler.handle` already holds self.lock here
+        # msg and args are kept unformatted, args may be mutated before dumping, which is the price of lazy formatting
+        self._buffer[self._index] = (record.created, record.levelno, record.name, record.msg, record.args,
+                                     record.pathname, record.lineno, record.funcName, record.exc_info,
+                                     record.process, record.threadName)
+        self._index = (self._index + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def get_records(self):
+        # return stored records as logging.LogRecord, from oldest to newest
+        self.acquire()
+        try:
+            start = (self._index - self._count) % self.capacity
+            items = [self._buffer[(start + i) % self.capacity] for i in range(self._count)]
+        finally:
+            self.release()
+
+        records = []
+        for created, levelno, name, msg, args, pathname, lineno, func_name, exc_info, process, thread_name in items:
+            record = logging.LogRecord(name, levelno, pathname, lineno, msg, args, exc_info, func_name)
+            record.created = created
+            record.msecs = (created - int(created)) * 1000
+            record.relativeCreated = (created - logging._startTime) * 1000
+            record.process = process
+            record.threadName = thread_name
+            records.append(record)
+        return records
+
+    def clear(self):
+        self.acquire()
+        try:
+            self._buffer = [None] * self.capacity
+            self._index = 0
+            self._count = 0
+        finally:
+            self.release()
+
+    def dump(self, dump_path=None, reason='manual', clear=False):
+        """Format all buffered records and append them to `dump_path` (or `self.dump_path`).
+        Returns the dump file path.
+        """
+        dump_path = dump_path or self.dump_path
+        if dump_path is None:
+            raise ValueError('dump_path must be specified either in RingBufferHandler.__init__ or in dump()!')
+        formatter = self.formatter or CustomFormatter(False, 2)
+
+        records = self.get_records()
+        lines = []
+        for record in records:
+            try:
+                lines.append(formatter.format(record))
+            except Exception:
+                # a broken record should not stop the whole dump
+                lines.append(f'<unformattable record: {record.msg!r} % {record.args!r}>')
+
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        dump_dir = os.path.dirname(os.path.abspath(dump_path))
+        if not os.path.exists(dump_dir):
+            os.makedirs(dump_dir, exist_ok=True)
+        with open(dump_path, 'a', encoding='utf-8') as f:
+            f.write(f'========== ring buffer dump | {now_str} | pid {os.getpid()} | reason: {reason} | {len(records)} records ==========\n')
+            if lines:
+                f.write('\n'.join(lines) + '\n')
+            f.flush()
+
+        if clear:
+            self.clear()
+        return dump_path
+
+    def install_crash_hooks(self, signals=(signal.SIGTERM,)):
+        """Dump the buffer on unhandled exceptions (main thread and other threads) and on the given signals.
+        The hooks are process-wide and installed only once, each call just registers this handler to be dumped,
+        so creating many ring buffers does not stack hook layers. Original hooks/handlers are chained,
+        so the default behavior is kept.
+        """
+        with RingBufferHandler._hooks_lock:
+            RingBufferHandler._crash_handlers.add(self)
+
+            if not RingBufferHandler._excepthooks_installed:
+                RingBufferHandler._excepthooks_installed = True
+
+                prev_excepthook = sys.excepthook
+                def excepthook(exc_type, exc_value, exc_tb):
+                    RingBufferHandler._dump_all(f'unhandled exception {exc_type.__name__}: {exc_value}')
+                    prev_excepthook(exc_type, exc_value, exc_tb)
+                sys.excepthook = excepthook
+
+                prev_threading_excepthook = threading.excepthook
+                def threading_excepthook(args):
+                    RingBufferHandler._dump_all(f'unhandled exception {args.exc_type.__name__} in thread {getattr(args.thread, "name", None)}: {args.exc_value}')
+                    prev_threading_excepthook(args)
+                threading.excepthook = threading_excepthook
+
+            for signum in signals or []:
+                if signum in RingBufferHandler._hooked_signals:
+                    continue
+                try:
+                    prev_handler = signal.getsignal(signum)
+                    signal.signal(signum, RingBufferHandler._make_signal_handler(prev_handler))
+                    RingBufferHandler._hooked_signals.add(signum)
+                except (ValueError, OSError, RuntimeError):
+                    # signal handlers can only be set in the main thread of the main interpreter
+                    stderr_write(f'RingBufferHandler: failed to install handler for signal {signum}, skipped.\n', True)
+
+    @classmethod
+    def _dump_all(cls, reason):
+        for handler in list(cls._crash_handlers):
+            handler._safe_dump(reason)
+
+    def _safe_dump(self, reason):
+        try:
+            self.dump(reason=reason)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+
+    @classmethod
+    def _make_signal_handler(cls, prev_handler):
+        def handler(sig, frame):
+            cls._dump_all(f'signal {signal.Signals(sig).name}')
+            if callable(prev_handler):
+                prev_handler(sig, frame)
+            elif prev_handler != signal.SIG_IGN:
+                # restore default behavior and re-raise, so the process exits as it would without us
+                signal.signal(sig, signal.SIG_DFL)
+                os.kill(os.getpid(), sig)
+        return handler
+
+
+class _PropagateHandler(logging.Handler):
+    def __init__(self, logger, level=logging.NOTSET):
+        """Forward records >= `level` to the handlers of the logger's ancestors, the same way `logging.Logger.callHandlers`
+        propagates them. Used in place of `logger.propagate` when the logger level is lowered for the ring buffer,
+        so parent/root handlers do not receive the extra low level records.
+        """
+        super().__init__(level)
+        self.logger = logger
+
+    def emit(self, record):
+        c = self.logger.parent
+        while c is not None:
+            for handler in c.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            if not c.propagate:
+                break
+            c = c.parent
+
+
+# default of `get_logger(formatter_template=...)`, so that handlers can tell an explicit template from the default one
+_DEFAULT_FORMATTER_TEMPLATE = object()
+
 
 class EasyLoggerManager(object):
     """
@@ -486,16 +677,27 @@ class EasyLoggerManager(object):
         p = Process(target=job, args=(i,))
         p.start()
 
-    (2) Some class methods:
+    (2) In-memory ring buffer for post-mortem analysis:
+    logger = EasyLoggerManager("test").get_logger(level=logging.WARNING,
+                                                  log_file_path="test.log",
+                                                  ring_buffer_size=10000,
+                                                  ring_buffer_dump_path="test.crash.log")
+    Console/file handlers only log WARNING and above, while the last 10000 records of all levels (DEBUG by default)
+    are kept in memory without formatting. They are dumped to test.crash.log on unhandled exceptions, SIGTERM,
+    or an explicit call of `EasyLoggerManager.dump_ring_buffer("test")`.
+
+    (3) Some class methods:
     get_logger_dict(),
     get_logger_names(),
     retrieve_logger(),
-    get_logger_level()
+    get_logger_level(),
+    dump_ring_buffer()
     
     """
 
     def __init__(self, name, propagate=True):
         self.logger_name = name
+        self.propagate = propagate
         self.logger = logging.getLogger(name)
         # I find some libs will modify the root logger's default behavior or hook on the root level
         # in this condition, set propagate as False will prevent from this pollution.
@@ -545,6 +747,16 @@ class EasyLoggerManager(object):
     def get_logger_level(cls, logger_name):
         logger = cls.retrieve_logger(logger_name)
         return logger.level
+
+    @classmethod
+    def dump_ring_buffer(cls, logger_name, dump_path=None, reason='manual', clear=False):
+        # explicitly dump all the RingBufferHandler of a logger, return the dumped file paths
+        logger = cls.retrieve_logger(logger_name)
+        dump_paths = []
+        for handler in logger.handlers:
+            if isinstance(handler, RingBufferHandler):
+                dump_paths.append(handler.dump(dump_path, reason=reason, clear=clear))
+        return dump_paths
     
 
     def get_logger(self,
@@ -557,15 +769,19 @@ class EasyLoggerManager(object):
                    log_file_backup_count=None,
                    log_file_rotate_interval=None,
                    log_file_multiprocessing=False,
-                   formatter_template=0,
+                   formatter_template=_DEFAULT_FORMATTER_TEMPLATE,
                    regex_filter=None,
-                   handler_singleton=False):
+                   handler_singleton=False,
+                   ring_buffer_size=None,
+                   ring_buffer_level=logging.DEBUG,
+                   ring_buffer_dump_path=None,
+                   ring_buffer_dump_signals=(signal.SIGTERM,)):
         """
         Create/get a logger with given parameters.
         level: logging level, default is logging.DEBUG
         log_to_console: whether to log to console, default is True
         stream_handler_color: whether to colorize the stream handler, default is False
-        formatter_template: the template of the formatter, default is 0
+        formatter_template: the template of the formatter, default is 0 (2 for the ring buffer dump if not given)
 
         log_file_path: the path of the log file, default is None
         log_file_mode: the mode of the log file, default is "a"
@@ -580,6 +796,14 @@ class EasyLoggerManager(object):
 
         handler_singleton: whether to use a singleton handler, default is False. logging module uses append method to
         add a handler, so multiple call will lead to adding multiple duplicate handlers.
+
+        ring_buffer_size: if set, keep the last `ring_buffer_size` records in memory, default is None (disabled)
+        ring_buffer_level: the level of records kept in the ring buffer, default is logging.DEBUG. It can be lower than `level`,
+        in which case console/file handlers still only log records >= `level`.
+        ring_buffer_dump_path: the file to dump the ring buffer to, default is None, which means `{log_file_path}.ringbuffer`
+        if log_file_path is set, otherwise `{logger_name}.ringbuffer.log`
+        ring_buffer_dump_signals: signals on which the ring buffer is dumped, default is (signal.SIGTERM,). Unhandled exceptions
+        always trigger a dump.
         """
         self.level = logging._checkLevel(level)
         self.log_to_console = log_to_console
@@ -590,23 +814,65 @@ class EasyLoggerManager(object):
         self.log_file_backup_count = log_file_backup_count
         self.log_file_rotate_interval = log_file_rotate_interval
         self.log_file_multiprocessing = log_file_multiprocessing
-        self.formatter_template = formatter_template
+        self.formatter_template_given = formatter_template is not _DEFAULT_FORMATTER_TEMPLATE
+        self.formatter_template = formatter_template if self.formatter_template_given else 0
         self.regex_filter = regex_filter
         self.handler_singleton = handler_singleton
+        self.ring_buffer_size = ring_buffer_size
+        self.ring_buffer_level = logging._checkLevel(ring_buffer_level)
+        self.ring_buffer_dump_path = ring_buffer_dump_path
+        self.ring_buffer_dump_signals = ring_buffer_dump_signals
 
         if getattr(self.logger, "stream_handler_added", None) is None:
             self.logger.stream_handler_added = False
         if getattr(self.logger, "log_file_handler_added", None) is None:
             self.logger.file_handler_added = False
-
-        self.logger.setLevel(self.level)
+        if getattr(self.logger, "ring_buffer_handler_added", None) is None:
+            self.logger.ring_buffer_handler_added = False
+
+        if self.ring_buffer_size:
+            # the logger itself must let the low level records pass through to the ring buffer,
+            # the other handlers are then filtered by their own level
+            self.logger.setLevel(min(self.level, self.ring_buffer_level))
+            if self.ring_buffer_level < self.level:
+                self.filter_propagation()
+        else:
+            self.logger.setLevel(self.level)
 
         self.add_handlers()
 
+        if self.ring_buffer_size and self.ring_buffer_level < self.level:
+            self.level_handlers()
+
         self.add_filter_to_handlers()
 
         return self.logger
 
+    def level_handlers(self):
+        # the logger level is lowered for the ring buffer, so every other handler (including the ones added by
+        # earlier `get_logger` calls, usually NOTSET) must filter by `self.level` itself
+        for handler in self.logger.handlers:
+            if isinstance(handler, (RingBufferHandler, _PropagateHandler)):
+                continue
+            if handler.level < self.level:
+                handler.setLevel(self.level)
+
+    def filter_propagation(self):
+        # parent handlers usually have no level set, so plain propagation would leak the low level records kept
+        # for the ring buffer to them. Propagate through a handler with `self.level` instead.
+        propagate_handler = getattr(self.logger, "propagate_handler", None)
+        if not self.propagate:
+            if propagate_handler is not None:
+                self.logger.removeHandler(propagate_handler)
+                self.logger.propagate_handler = None
+            return
+        self.logger.propagate = False
+        if propagate_handler is not None:
+            propagate_handler.setLevel(min(propagate_handler.level, self.level))
+        else:
+            self.logger.propagate_handler = _PropagateHandler(self.logger, self.level)
+            self.logger.addHandler(self.logger.propagate_handler)
+
     def add_filter_to_handlers(self):
         if self.regex_filter is not None:
             pattern = re.compile(self.regex_filter)
@@ -619,6 +885,8 @@ class EasyLoggerManager(object):
             self.add_stream_handler()
         if self.log_file_path:
             self.add_file_handler()
+        if self.ring_buffer_size:
+            self.add_ring_buffer_handler()
     
     def add_stream_handler(self):
         if (not self.handler_singleton) or (self.handler_singleton and self.logger.stream_handler_added is False):
@@ -650,6 +918,22 @@ class EasyLoggerManager(object):
             self.logger.addHandler(handler)
 
             self.logger.file_handler_added = True
+
+    def add_ring_buffer_handler(self):
+        if (not self.handler_singleton) or (self.handler_singleton and self.logger.ring_buffer_handler_added is False):
+            dump_path = self.ring_buffer_dump_path
+            if dump_path is None:
+                dump_path = f'{self.log_file_path}.ringbuffer' if self.log_file_path else f'{self.logger_name}.ringbuffer.log'
+            # NOTE: the dump file is a plain text file, disable color hightlighting
+            # formatter_template 2 is used when no template is given, since the crash context needs file and line info
+            formatter_template = self.formatter_template if self.formatter_template_given else 2
+            handler = RingBufferHandler(self.ring_buffer_size, dump_path=dump_path, level=self.ring_buffer_level)
+            handler.setFormatter(CustomFormatter(False, formatter_template))
+            handler.install_crash_hooks(self.ring_buffer_dump_signals)
+
+            self.logger.addHandler(handler)
+
+            self.logger.ring_buffer_handler_added = True
             
 
 if __name__ == "__main__":
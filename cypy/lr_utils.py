@@ -1,5 +1,7 @@
+import numpy as np
 import torch
-from torch.optim.lr_scheduler import _LRScheduler
+from torch.optim.lr_scheduler import _LRScheduler, ReduceLROnPlateau, StepLR, MultiStepLR, CosineAnnealingLR, \
+    LinearLR, ExponentialLR
 
 
 class GradualWarmupScheduler(_LRScheduler):
@@ -13,6 +15,11 @@ class GradualWarmupScheduler(_LRScheduler):
 
     NOTE: referred from "https://github.com/ildoonet/pytorch-gradual-warmup-lr" with modifications
     modification1: in `get_lr` func, change `self.last_epoch` to `self.last_epoch + 1`, so that we can normally call schehuder.step() after optimizer.step()
+    
+    modification2: the warmup lr is closed-form, computed for all the param groups at once, and `step` writes it
+    directly instead of going through `_LRScheduler.step`, which matters with thousands of param groups.
+    modification3: at the handoff, `after_scheduler` starts from base_lr * multiplier (both its base_lrs and last lr),
+    and `state_dict` saves the state of `after_scheduler` (instead of the object), so resuming gives the same lr.
     """
     
     def __init__(self, optimizer, multiplier, total_epoch, after_scheduler=None):
@@ -22,24 +29,46 @@ class GradualWarmupScheduler(_LRScheduler):
         self.total_epoch = total_epoch
         self.after_scheduler = after_scheduler
         self.finished = False
+        self._base_lrs_np = None
         super(GradualWarmupScheduler, self).__init__(optimizer)
-        
+
+    def warmup_factor(self, epoch):
+        # lr / base_lr at `epoch` (the value of last_epoch), closed-form, also valid for numpy arrays of epochs
+        if self.multiplier == 1.0:
+            factor = (epoch + 1.) / self.total_epoch
+        else:
+            factor = (self.multiplier - 1.) * (epoch + 1.) / self.total_epoch + 1.
+        return np.minimum(factor, float(self.multiplier)) if isinstance(epoch, np.ndarray) else min(factor, self.multiplier)
+
+    def _scaled_base_lrs(self, factor):
+        if self._base_lrs_np is None or len(self._base_lrs_np) != len(self.base_lrs):
+            self._base_lrs_np = np.asarray(self.base_lrs, dtype=np.float64)
+        return (self._base_lrs_np * factor).tolist()
+
     def get_lr(self):
         if self.last_epoch >= self.total_epoch:
+            target_lrs = self._scaled_base_lrs(self.multiplier)
             if self.after_scheduler:
                 if not self.finished:
-                    self.after_scheduler.base_lrs = [base_lr * self.multiplier for base_lr in self.base_lrs]
+                    self.after_scheduler.base_lrs = list(target_lrs)
+                    self.after_scheduler._last_lr = list(target_lrs)
                     self.finished = True
                 return self.after_scheduler.get_last_lr()
-            return [base_lr * self.multiplier for base_lr in self.base_lrs]
-        
-        if self.multiplier == 1.0:
-            return [base_lr * (float(self.last_epoch + 1) / self.total_epoch) for base_lr in self.base_lrs]
-        else:
-            return [base_lr * ((self.multiplier - 1.) * (self.last_epoch + 1) / self.total_epoch + 1.) for base_lr in self.base_lrs]
-                
+            return target_lrs
+        return self._scaled_base_lrs(self.warmup_factor(self.last_epoch))
+
+    def _set_lrs(self, lrs):
+        for group, lr in zip(self.optimizer.param_groups, lrs):
+            group['lr'] = lr
+        self._last_lr = list(lrs)
+
     def step(self, epoch=None, metrics=None):
         if self.finished and self.after_scheduler:
+            if isinstance(self.after_scheduler, ReduceLROnPlateau):
+                self.after_scheduler.step(metrics)
+                self.last_epoch += 1
+                self._last_lr = [group['lr'] for group in self.optimizer.param_groups]
+                return
             if epoch is None:
                 self.after_scheduler.step(None)
             else:
@@ -47,14 +76,152 @@ class GradualWarmupScheduler(_LRScheduler):
             self.last_epoch = self.after_scheduler.last_epoch + self.total_epoch + 1
             self._last_lr = self.after_scheduler.get_last_lr()
         else:
-            return super(GradualWarmupScheduler, self).step(epoch)
+            self._step_count += 1
+            self.last_epoch = self.last_epoch + 1 if epoch is None else epoch
+            self._set_lrs(self.get_lr())
+
+    def state_dict(self):
+        state = {key: value for key, value in self.__dict__.items()
+                 if key not in ['optimizer', 'after_scheduler', '_base_lrs_np']}
+        state['after_scheduler'] = self.after_scheduler.state_dict() if self.after_scheduler is not None else None
+        return state
+
+    def load_state_dict(self, state_dict):
+        state = dict(state_dict)
+        after_state = state.pop('after_scheduler', None)
+        self.__dict__.update(state)
+        self._base_lrs_np = None
+        # old checkpoints pickled the after_scheduler object itself, its state can not be restored from them
+        if self.after_scheduler is not None and isinstance(after_state, dict):
+            self.after_scheduler.load_state_dict(after_state)
+
+
+AFTER_SCHEDULERS = ['step', 'multistep', 'cosine', 'linear', 'exp']
+
+
+def _check_schedule_config(config):
+    after_cfg = dict(config.get('after_scheduler') or {})
+    after_type = after_cfg.pop('type', None)
+    assert after_type is None or after_type in AFTER_SCHEDULERS, \
+        f'after_scheduler type must be one of {AFTER_SCHEDULERS}, but got {after_type}'
+    warmup_cfg = config.get('warmup') or {}
+    return after_type, after_cfg, warmup_cfg
+
+
+def build_scheduler(optimizer, config):
+    """Build the (warmup +) after scheduler described by `config`, the stepping counterpart of `simulate_schedule`.
+
+    config e.g.:
+    {
+        'warmup': {'multiplier': 1, 'total_epoch': 5},  # optional, kwargs of GradualWarmupScheduler
+        'after_scheduler': {'type': 'multistep', 'milestones': [30, 60], 'gamma': 0.1},  # optional
+    }
+    after_scheduler types and their kwargs (same names as torch):
+        'step': StepLR(step_size, gamma=0.1)
+        'multistep': MultiStepLR(milestones, gamma=0.1)
+        'cosine': CosineAnnealingLR(T_max, eta_min=0)
+        'linear': LinearLR(start_factor=1, end_factor, total_iters), decays from the lr reached after warmup
+        'exp': ExponentialLR(gamma)
+    """
+    after_type, after_cfg, warmup_cfg = _check_schedule_config(config)
+    after_scheduler = None
+    if after_type == 'step':
+        after_scheduler = StepLR(optimizer, **after_cfg)
+    elif after_type == 'multistep':
+        after_scheduler = MultiStepLR(optimizer, **after_cfg)
+    elif after_type == 'cosine':
+        after_scheduler = CosineAnnealingLR(optimizer, **after_cfg)
+    elif after_type == 'linear':
+        after_scheduler = LinearLR(optimizer, start_factor=1., **after_cfg)
+    elif after_type == 'exp':
+        after_scheduler = ExponentialLR(optimizer, **after_cfg)
+    if warmup_cfg:
+        return GradualWarmupScheduler(optimizer, after_scheduler=after_scheduler, **warmup_cfg)
+    return after_scheduler
+
+
+def simulate_schedule(config, total_steps, base_lr=None):
+    """Return the lr of each step (the lr used by the optimizer at step 0, 1, ..., total_steps - 1) as a numpy array,
+    computed in closed form instead of stepping a scheduler with a dummy optimizer.
+    Same lr curve as the scheduler returned by `build_scheduler(optimizer, config)`.
+
+    Args:
+        config (dict): see `build_scheduler`, may also have 'base_lr'.
+        base_lr (float || None): overrides config['base_lr'], which defaults to 1. (then the curve is the lr factor).
+    """
+    after_type, after_cfg, warmup_cfg = _check_schedule_config(config)
+    if base_lr is None:
+        base_lr = config.get('base_lr', 1.)
+    steps = np.arange(total_steps, dtype=np.float64)
+
+    multiplier = float(warmup_cfg.get('multiplier', 1.))
+    warmup_steps = int(warmup_cfg.get('total_epoch', 0))
+    target_lr = base_lr * multiplier
+    lrs = np.empty(total_steps, dtype=np.float64)
+
+    # warmup phase, same formula as GradualWarmupScheduler.warmup_factor
+    warmup = steps[:warmup_steps]
+    if multiplier == 1.:
+        lrs[:warmup_steps] = base_lr * ((warmup + 1.) / max(warmup_steps, 1))
+    else:
+        lrs[:warmup_steps] = base_lr * ((multiplier - 1.) * (warmup + 1.) / max(warmup_steps, 1) + 1.)
+
+    # after phase, `a` is the last_epoch of the after scheduler
+    a = steps[warmup_steps:] - warmup_steps
+    if after_type is None:
+        after = np.full_like(a, target_lr)
+    elif after_type == 'step':
+        after = target_lr * after_cfg.get('gamma', 0.1) ** np.floor(a / after_cfg['step_size'])
+    elif after_type == 'multistep':
+        milestones = np.sort(np.asarray(after_cfg['milestones']))
+        # repeated milestones decay multiple times, as MultiStepLR does
+        after = target_lr * after_cfg.get('gamma', 0.1) ** np.searchsorted(milestones, a, side='right')
+    elif after_type == 'cosine':
+        eta_min = after_cfg.get('eta_min', 0.)
+        after = eta_min + (target_lr - eta_min) * (1. + np.cos(np.pi * a / after_cfg['T_max'])) / 2.
+    elif after_type == 'linear':
+        total_iters = after_cfg.get('total_iters', 5)
+        end_factor = after_cfg.get('end_factor', 1. / 3)
+        after = target_lr * (1. + (end_factor - 1.) * np.minimum(a, total_iters) / total_iters)
+    elif after_type == 'exp':
+        after = target_lr * after_cfg['gamma'] ** a
+    lrs[warmup_steps:] = after
+    return lrs
+
+
+def _check_simulate_schedule():
+    # check simulate_schedule against stepping the schedulers, runs without matplotlib
+    configs = [
+        {'warmup': {'multiplier': 1, 'total_epoch': 4}, 'after_scheduler': {'type': 'multistep', 'milestones': [5, 8]}},
+        {'warmup': {'multiplier': 4, 'total_epoch': 10}, 'after_scheduler': {'type': 'step', 'step_size': 7, 'gamma': 0.5}},
+        {'warmup': {'multiplier': 2, 'total_epoch': 5}, 'after_scheduler': {'type': 'cosine', 'T_max': 50, 'eta_min': 1e-5}},
+        {'warmup': {'multiplier': 1, 'total_epoch': 3}, 'after_scheduler': {'type': 'linear', 'end_factor': 0.1, 'total_iters': 30}},
+        {'warmup': {'multiplier': 1, 'total_epoch': 6}, 'after_scheduler': {'type': 'exp', 'gamma': 0.95}},
+        {'warmup': {'multiplier': 3, 'total_epoch': 6}},
+        {'after_scheduler': {'type': 'cosine', 'T_max': 40}},
+    ]
+    for config in configs:
+        t = torch.tensor([0.0], requires_grad=True)
+        optim = torch.optim.SGD([t], lr=0.01)
+        scheduler = build_scheduler(optim, config)
+        stepped = []
+        for _ in range(100):
+            stepped.append(optim.param_groups[0]['lr'])
+            optim.step()
+            scheduler.step()
+        simulated = simulate_schedule(config, 100, base_lr=0.01)
+        assert np.allclose(simulated, stepped, rtol=1e-6, atol=1e-12), f'simulate_schedule does not match stepping for {config}'
+    print('simulate_schedule matches stepping')
+
 
 if __name__ == "__main__":
+    _check_simulate_schedule()
+
+    try:
+        import matplotlib.pyplot as plt  # only for the plotting below
+    except ImportError:
+        plt = None
 
-    from torch.optim.lr_scheduler import MultiStepLR, StepLR
-    import numpy as np
-    import matplotlib.pyplot as plt
-    
     t = torch.tensor([0.0], requires_grad=True)
     optim = torch.optim.SGD([t], lr=0.01)
 
@@ -72,4 +239,4 @@ if __name__ == "__main__":
     #lrs = np.array(lrs)
     #print(lrs)
     #plt.plot(lrs[:, 0], lrs[:, 1])
-    #plt.show()
\ No newline at end of file
+    #plt.show()
@@ -6,18 +6,31 @@ from scipy.interpolate import interp1d
 
 
 def find_best_threshold(y_trues, y_preds):
+    # a prediction is positive if y_pred > threshold, so for each candidate threshold (unique y_preds),
+    # the confusion counts are given by how many positive/negative scores are <= threshold.
+    # All the candidates are evaluated by one sorted sweep (searchsorted) instead of calling `cal_metrics` for each one.
     print("Finding best threshold...")
-    best_thre = 0.5
-    best_metrics = None
-    candidate_thres = list(np.unique(np.sort(y_preds)))
-    for thre in candidate_thres:
-        metrics = cal_metrics(y_trues, y_preds, threshold=thre)
-        if best_metrics is None:
-            best_metrics = metrics
-            best_thre = thre
-        elif metrics.ACER < best_metrics.ACER:
-            best_metrics = metrics
-            best_thre = thre
+    y_trues = np.asarray(y_trues).ravel()
+    y_preds = np.asarray(y_preds).ravel()
+    candidate_thres = np.unique(y_preds)
+
+    # the larger label is the positive one, same as the label order of `confusion_matrix`
+    pos_mask = y_trues == np.unique(y_trues)[-1]
+    pos_preds = np.sort(y_preds[pos_mask])
+    neg_preds = np.sort(y_preds[~pos_mask])
+
+    FN = np.searchsorted(pos_preds, candidate_thres, side='right')
+    TN = np.searchsorted(neg_preds, candidate_thres, side='right')
+    TP = len(pos_preds) - FN
+    FP = len(neg_preds) - TN
+
+    APCER = FP / (TN + FP)
+    BPCER = FN / (FN + TP)
+    ACER = (APCER + BPCER) / 2
+
+    # argmin returns the first (smallest) threshold on ties, the same as the strict `<` comparison in a loop
+    best_thre = candidate_thres[np.argmin(ACER)]
+    best_metrics = cal_metrics(y_trues, y_preds, threshold=best_thre)
     print(f"Best threshold is {best_thre}")
     return best_thre, best_metrics
 
@@ -54,4 +67,152 @@ def cal_metrics(y_trues, y_preds, threshold=0.5):
     metrics.BPCER = float(FN / (FN + TP))
     metrics.ACER = (metrics.APCER + metrics.BPCER) / 2
     
-    return metrics
\ No newline at end of file
+    return metrics
+
+
+class HistogramMetrics(object):
+    """Streaming version of `cal_metrics`. Scores of each class are accumulated into fixed-bin histograms, so the memory
+    is O(num_bins) regardless of the eval set size, and accumulators from different workers/ranks can be merged by
+    simply adding the histograms. Bins are right-closed, (edge_i, edge_i+1], so that counting the bins above an edge
+    counts the scores strictly above it, the same as the `y_pred > threshold` of `cal_metrics`.
+
+    Args:
+        num_bins (int): number of score bins. Thresholds are searched on the bin edges, so the threshold resolution
+            is (score_range[1] - score_range[0]) / num_bins, and AUC/EER are exact for scores quantized to that resolution.
+            Defaults to 10000.
+        score_range (tuple): (min, max) of the scores, scores out of the range (and scores equal to min) are clipped
+            into the first/last bin.
+            Defaults to (0., 1.).
+        pos_label (int): label of the positive class, other labels are negative. Defaults to 1.
+
+    e.g.:
+    meter = HistogramMetrics()
+    for y_trues, y_preds in loader:
+        meter.update(y_trues, y_preds)
+    metrics = meter.compute(threshold='best')
+    """
+
+    def __init__(self, num_bins=10000, score_range=(0., 1.), pos_label=1):
+        assert num_bins > 0, f'num_bins must be positive, but got {num_bins}'
+        assert score_range[1] > score_range[0], f'Invalid score_range: {score_range}'
+        self.num_bins = int(num_bins)
+        self.score_range = (float(score_range[0]), float(score_range[1]))
+        self.pos_label = pos_label
+        self.bin_width = (self.score_range[1] - self.score_range[0]) / self.num_bins
+        self.edges = np.linspace(self.score_range[0], self.score_range[1], self.num_bins + 1)
+        self.reset()
+
+    @classmethod
+    def from_resolution(cls, resolution, score_range=(0., 1.), pos_label=1):
+        # build with the max allowed threshold error instead of the number of bins
+        num_bins = int(np.ceil((score_range[1] - score_range[0]) / resolution))
+        return cls(num_bins=num_bins, score_range=score_range, pos_label=pos_label)
+
+    def reset(self):
+        # row 0: negative scores, row 1: positive scores
+        self.hist = np.zeros((2, self.num_bins), dtype=np.int64)
+
+    @staticmethod
+    def _to_numpy(x):
+        if hasattr(x, 'detach'):  # torch tensor
+            x = x.detach().cpu().numpy()
+        return np.asarray(x).ravel()
+
+    def update(self, y_trues, y_preds):
+        y_trues = self._to_numpy(y_trues)
+        y_preds = self._to_numpy(y_preds).astype(np.float64)
+        assert len(y_trues) == len(y_preds), f'Length mismatch: {len(y_trues)} labels vs {len(y_preds)} scores'
+        # right-closed bins: a score exactly on an edge belongs to the bin below it. Positions within 1e-6 bin of an edge
+        # are snapped first, otherwise float errors (e.g. 0.5 / 1e-4 = 4999.999...) would put edge scores on either side
+        pos = (y_preds - self.score_range[0]) / self.bin_width
+        rounded = np.round(pos)
+        pos = np.where(np.abs(pos - rounded) < 1e-6, rounded, pos)
+        bin_idx = np.ceil(pos).astype(np.int64) - 1
+        np.clip(bin_idx, 0, self.num_bins - 1, out=bin_idx)
+        pos_mask = y_trues == self.pos_label
+        self.hist[1] += np.bincount(bin_idx[pos_mask], minlength=self.num_bins)
+        self.hist[0] += np.bincount(bin_idx[~pos_mask], minlength=self.num_bins)
+        return self
+
+    def _check_compatible(self, other):
+        assert self.num_bins == other.num_bins and self.score_range == other.score_range, \
+            f'Can not merge histograms with different bins: {self.num_bins} {self.score_range} vs {other.num_bins} {other.score_range}'
+
+    def merge(self, other):
+        self._check_compatible(other)
+        self.hist += other.hist
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def __len__(self):
+        return int(self.hist.sum())
+
+    def _roc(self):
+        # counts of scores > each edge, from the lowest edge (everything is positive) to the highest (nothing is)
+        neg_gt = np.concatenate([np.cumsum(self.hist[0][::-1])[::-1], [0]])
+        pos_gt = np.concatenate([np.cumsum(self.hist[1][::-1])[::-1], [0]])
+        return neg_gt, pos_gt
+
+    def compute(self, threshold=0.5):
+        """Same fields as `cal_metrics`: AUC, EER, Thre, ACC, TPR, TNR, APCER, BPCER, ACER.
+
+        Args:
+            threshold (float || str): float, 'auto' (the EER threshold) or 'best' (the one with the lowest ACER).
+                Snapped down to the bin edge at or below it, scores are then counted as positive if > that edge,
+                which is exact for scores quantized to the bins. Defaults to 0.5.
+        """
+        neg_gt, pos_gt = self._roc()
+        N, P = int(neg_gt[0]), int(pos_gt[0])
+        assert N > 0 and P > 0, f'Both classes are needed to compute metrics, but got {P} positives and {N} negatives'
+
+        # ROC points ordered by fpr ascending (threshold descending)
+        fpr = (neg_gt / N)[::-1]
+        tpr = (pos_gt / P)[::-1]
+        # `roc_curve` labels a point by the lowest score counted as positive, for "> edge" that is the next edge
+        thres = (self.edges + self.bin_width)[::-1]
+
+        metrics = EasyDict()
+        metrics.AUC = float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1])) / 2)
+
+        # EER: where the piecewise linear ROC crosses fpr = 1 - tpr
+        diff = 1. - fpr - tpr
+        idx = max(int(np.argmax(diff <= 0)), 1)
+        ratio = diff[idx - 1] / (diff[idx - 1] - diff[idx]) if diff[idx - 1] != diff[idx] else 0.
+        metrics.EER = float(fpr[idx - 1] + ratio * (fpr[idx] - fpr[idx - 1]))
+        metrics.Thre = float(thres[idx - 1] + ratio * (thres[idx] - thres[idx - 1]))
+
+        if threshold == 'best':
+            acer = ((neg_gt / N) + (1. - pos_gt / P)) / 2
+            edge_idx = int(np.argmin(acer))
+        else:
+            if threshold == 'auto':
+                threshold = metrics.Thre
+            # 1e-6 bin of tolerance for float errors of thresholds on an edge
+            edge_idx = int(np.clip(np.floor((threshold - self.score_range[0]) / self.bin_width + 1e-6), 0, self.num_bins))
+
+        FP, TP = int(neg_gt[edge_idx]), int(pos_gt[edge_idx])
+        TN, FN = N - FP, P - TP
+        metrics.ACC = (TP + TN) / (N + P)
+        metrics.TPR = TP / (TP + FN)
+        metrics.TNR = TN / (TN + FP)
+        metrics.APCER = FP / (TN + FP)
+        metrics.BPCER = FN / (FN + TP)
+        metrics.ACER = (metrics.APCER + metrics.BPCER) / 2
+        return metrics
+
+
+if __name__ == "__main__":
+    # HistogramMetrics must agree with cal_metrics on scores quantized to the bin resolution
+    rng = np.random.RandomState(0)
+    y_trues = rng.randint(0, 2, 20000)
+    for num_bins, decimals in [(1000, 3), (10000, 4), (100, 2)]:
+        y_preds = np.round(np.clip(rng.normal(0.35 + 0.3 * y_trues, 0.15), 0, 1), decimals)
+        meter = HistogramMetrics(num_bins=num_bins).update(y_trues, y_preds)
+        for threshold in [0.5, 0.3, 'auto', 'best']:
+            expected = cal_metrics(y_trues, y_preds, threshold=threshold)
+            metrics = meter.compute(threshold=threshold)
+            for k in expected:
+                assert abs(float(metrics[k]) - float(expected[k])) < 1e-4, f'{num_bins} bins, threshold {threshold}, {k}: {metrics[k]} vs {expected[k]}'
+    print('HistogramMetrics agrees with cal_metrics')
@@ -1,10 +1,24 @@
 import os
+import re
+import json
+import math
+import time
+import logging
+import sys
+import shlex
+import signal
+import importlib
 import subprocess
+import threading
+import collections
 import functools
 import inspect
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-from cypy.logging_utils import logging_color_set
+import numpy as np
+
+from cypy.logging_utils import logging_color_set, EasyLoggerManager
 
 
 class LazyImport:
@@ -23,21 +37,320 @@ class LazyImport:
 
     Then, we can use decord.VideoReader to read video.
 
+    Dotted names give the submodule itself, e.g. LazyImport('torch.nn.functional').relu.
+    The first access is thread-safe (the module is imported once), and the import time is recorded,
+    see `get_lazy_import_times`. Use `preload` to warm the imports in a background thread at startup.
+
     '''
     def __init__(self, module_name):
         self.module_name = module_name
         self.module = None
-    
+        self._lock = threading.Lock()
+
+    def _load(self):
+        module = self.module
+        if module is None:
+            with self._lock:
+                if self.module is None:
+                    self.module = _timed_import(self.module_name)
+                module = self.module
+        return module
+
+    @property
+    def is_loaded(self):
+        return self.module is not None
+
     def __getattr__(self, name):
-        if self.module is None:
-            self.module = __import__(self.module_name)
-        return getattr(self.module, name)
+        # only called for attributes not found on the LazyImport itself
+        if name in ['module', 'module_name', '_lock'] or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __getstate__(self):
+        # modules can not be pickled, re-import lazily on the other side
+        return {'module_name': self.module_name}
+
+    def __setstate__(self, state):
+        self.__init__(state['module_name'])
+
+    def __repr__(self):
+        return f"<LazyImport '{self.module_name}' ({'loaded' if self.is_loaded else 'not loaded'})>"
+
+
+# module name -> seconds spent importing it (including its own imports), only for the modules imported by LazyImport
+_LAZY_IMPORT_TIMES = collections.OrderedDict()
+
+
+def _timed_import(module_name):
+    already_imported = module_name in sys.modules
+    tic = time.perf_counter()
+    module = importlib.import_module(module_name)
+    if not already_imported:
+        _LAZY_IMPORT_TIMES[module_name] = time.perf_counter() - tic
+    return module
+
+
+def get_lazy_import_times():
+    # {module name: import seconds}, slowest first
+    return collections.OrderedDict(sorted(_LAZY_IMPORT_TIMES.items(), key=lambda x: -x[1]))
+
+
+def preload(modules, background=True):
+    '''
+    Import modules ahead of their first use, e.g. while the main thread parses the config / builds the dataset.
+    modules: a list of module names or LazyImport instances.
+    background: import in a daemon thread and return it (join it to wait), otherwise import in the current thread.
+    Import errors are only warned, the error is raised again on the real access.
+    '''
+    def load_all():
+        for module in modules:
+            try:
+                if isinstance(module, LazyImport):
+                    module._load()
+                else:
+                    _timed_import(module)
+            except Exception as e:
+                name = module.module_name if isinstance(module, LazyImport) else module
+                warn_print(f'preload of [{name}] failed: {e}')
+
+    modules = list(modules)
+    if not background:
+        load_all()
+        return None
+    thread = threading.Thread(target=load_all, name='cypy-preload', daemon=True)
+    thread.start()
+    return thread
+
+
+def get_cmd_output(cmd, timeout=None):
+    # shell string version, kept for pipelines like `ps aux | grep xxx`. Prefer `run_cmd` with argv for others.
+    # if timeout (seconds) is set, the whole process group is killed on timeout and the output so far is returned
+    if timeout is None:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        stdout, stderr = process.communicate()
+        return stdout.decode("utf-8").strip(), stderr.decode("utf-8").strip()
+    res = run_cmd(cmd, timeout=timeout, shell=True)
+    return res.stdout.strip(), res.stderr.strip()
+
+
+CmdResult = collections.namedtuple('CmdResult', ['cmd', 'returncode', 'stdout', 'stderr', 'timed_out', 'cancelled'])
+
+
+def _kill_process_group(process):
+    # processes are started in a new session, so the whole tree (e.g. sh -> ffmpeg) is killed
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    except Exception:
+        process.kill()
+
+
+def _read_stream(stream, chunks, line_callback=None, max_lines=None):
+    # read a pipe until EOF. `\r` is treated as a line break as well, since ffmpeg refreshes its progress line with it
+    if line_callback is None and max_lines is None:
+        chunks.append(stream.read())
+        return
+    lines = collections.deque(maxlen=max_lines)
+    pending = b''
+    while True:
+        data = stream.read1(65536) if hasattr(stream, 'read1') else stream.read(65536)
+        if not data:
+            break
+        pending += data
+        parts = re.split(rb'\r\n|\r|\n', pending)
+        pending = parts.pop()
+        for part in parts:
+            line = part.decode('utf-8', errors='ignore')
+            lines.append(line)
+            if line_callback is not None:
+                line_callback(line)
+    if pending:
+        line = pending.decode('utf-8', errors='ignore')
+        lines.append(line)
+        if line_callback is not None:
+            line_callback(line)
+    chunks.append('\n'.join(lines).encode('utf-8'))
+
+
+def run_cmd(cmd, timeout=None, shell=False, cwd=None, env=None, stderr_callback=None, max_stderr_lines=None,
+            cancel_event=None, check=False, poll_interval=0.1):
+    """Run a command without shell by default, with timeout and cancellation support.
+
+    Args:
+        cmd (list || str):
+            argv list, e.g. ['ffmpeg', '-i', video_path, '-f', 'null', '-']. If str and shell is False, it is split by shlex.
+        timeout (float || None, optional):
+            Seconds. The process group is killed on timeout. Defaults to None (no timeout).
+        shell (bool, optional):
+            Run `cmd` (str) through the shell. Defaults to False.
+        stderr_callback (callable || None, optional):
+            Called with each stderr line as soon as it is produced, e.g. to parse live ffmpeg progress with `parse_ffmpeg_progress`.
+            Defaults to None.
+        max_stderr_lines (int || None, optional):
+            Only keep the last n stderr lines in the result, bounds the memory of chatty processes. Defaults to None (keep all).
+        cancel_event (threading.Event || None, optional):
+            The process group is killed once the event is set. Defaults to None.
+        check (bool, optional):
+            Raise subprocess.CalledProcessError if returncode != 0 (or subprocess.TimeoutExpired on timeout). Defaults to False.
+
+    Returns:
+        CmdResult: namedtuple of (cmd, returncode, stdout, stderr, timed_out, cancelled). stdout/stderr are decoded str.
+    """
+    if isinstance(cmd, str) and not shell:
+        cmd = shlex.split(cmd)
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+                               shell=shell, cwd=cwd, env=env, start_new_session=True)
+    stdout_chunks, stderr_chunks = [], []
+    readers = [threading.Thread(target=_read_stream, args=(process.stdout, stdout_chunks), daemon=True),
+               threading.Thread(target=_read_stream, args=(process.stderr, stderr_chunks, stderr_callback, max_stderr_lines), daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    timed_out = cancelled = False
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        while True:
+            wait_time = poll_interval if cancel_event is not None else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                wait_time = remaining if wait_time is None else min(wait_time, remaining)
+            try:
+                process.wait(timeout=None if wait_time is None else max(wait_time, 0))
+                break
+            except subprocess.TimeoutExpired:
+                if deadline is not None and time.monotonic() >= deadline:
+                    timed_out = True
+                elif cancel_event is not None and cancel_event.is_set():
+                    cancelled = True
+                if timed_out or cancelled:
+                    _kill_process_group(process)
+                    process.wait()
+                    break
+    except BaseException:
+        # e.g. KeyboardInterrupt, never leave an orphan process behind
+        _kill_process_group(process)
+        process.wait()
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+        process.stdout.close()
+        process.stderr.close()
+
+    res = CmdResult(cmd, process.returncode, b''.join(stdout_chunks).decode('utf-8', errors='ignore'),
+                    b''.join(stderr_chunks).decode('utf-8', errors='ignore'), timed_out, cancelled)
+    if check:
+        if timed_out:
+            raise subprocess.TimeoutExpired(cmd, timeout, output=res.stdout, stderr=res.stderr)
+        if res.returncode != 0:
+            raise subprocess.CalledProcessError(res.returncode, cmd, output=res.stdout, stderr=res.stderr)
+    return res
+
+
+_ffmpeg_progress_pattern = re.compile(r'(frame|fps|size|Lsize|time|bitrate|speed)=\s*(\S+)')
+
+
+def parse_ffmpeg_progress(line):
+    """Parse a ffmpeg progress line, e.g. `frame=  400 fps=0.0 q=-0.0 Lsize=N/A time=00:00:03.98 bitrate=N/A speed= 100x`.
+    Return a dict with keys among frame(int), fps(float), time(float, seconds), speed(float), size(str), bitrate(str),
+    or None if the line is not a progress line.
+    """
+    if 'time=' not in line:
+        return None
+    progress = {}
+    for key, val in _ffmpeg_progress_pattern.findall(line):
+        if val == 'N/A':
+            continue
+        try:
+            if key == 'frame':
+                progress['frame'] = int(val)
+            elif key == 'fps':
+                progress['fps'] = float(val)
+            elif key == 'time':
+                sign = -1 if val.startswith('-') else 1
+                hour, minute, second = [float(x) for x in val.lstrip('-').split(':')]
+                progress['time'] = sign * (hour * 3600 + minute * 60 + second)
+            elif key == 'speed':
+                progress['speed'] = float(val.rstrip('x'))
+            else:
+                progress['size' if key == 'Lsize' else key] = val
+        except ValueError:
+            continue
+    return progress
+
 
+class CmdRunner(object):
+    """
+    Bounded concurrent command runner, each command runs with `run_cmd` in a thread pool and a Future is returned.
+
+    e.g.:
+    with CmdRunner(max_workers=4, timeout=600) as runner:
+        futures = [runner.submit(['ffmpeg', '-y', '-i', src, dst]) for src, dst in pairs]
+        for future in concurrent.futures.as_completed(futures):
+            res = future.result()  # CmdResult
+        ...
+        runner.cancel_all()  # cancel pending commands and kill running ones
+    """
 
-def get_cmd_output(cmd):
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    stdout, stderr = process.communicate()
-    return stdout.decode("utf-8").strip(), stderr.decode("utf-8").strip()
+    def __init__(self, max_workers=4, timeout=None, **run_kwargs):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.run_kwargs = run_kwargs
+        self._cancel_event = threading.Event()
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, cmd, **kwargs):
+        # kwargs are passed to `run_cmd` and override the runner defaults
+        run_kwargs = dict(self.run_kwargs)
+        run_kwargs.setdefault('timeout', self.timeout)
+        run_kwargs.setdefault('cancel_event', self._cancel_event)
+        run_kwargs.update(kwargs)
+        future = self._executor.submit(run_cmd, cmd, **run_kwargs)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def map(self, cmds, **kwargs):
+        # yield CmdResult in the order of cmds
+        futures = [self.submit(cmd, **kwargs) for cmd in cmds]
+        for future in futures:
+            yield future.result()
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def cancel_all(self):
+        # cancel all pending commands and kill the running ones, the runner can be used again afterwards
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        self._cancel_event.set()
+        for future in futures:
+            if not future.cancelled():
+                try:
+                    future.result()
+                except Exception:
+                    pass
+        self._cancel_event = threading.Event()
+
+    def shutdown(self, wait=True, cancel=False):
+        if cancel:
+            self.cancel_all()
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # cancel everything if leaving on an exception
+        self.shutdown(wait=True, cancel=exc_type is not None)
 
 
 def color_print(info, color='grey'):
@@ -155,6 +468,252 @@ def deprecated(reason):
         raise TypeError(repr(type(reason)))
 
 
+# ---------------------------------------------------------------------------------------------------------------------
+# timing registry: `@timed` / `with timer('name')`, disabled by default, a flag check only when disabled
+# e.g.:
+# enable_timing(trace=True)
+# @timed
+# def load(x): ...
+# with timer('decode'):
+#     ...
+# start_timing_reporter(interval=60)  # log p50/p95/p99 every 60s through EasyLoggerManager
+# export_chrome_trace('trace.json')  # open in chrome://tracing or https://ui.perfetto.dev
+_TIMING_ENABLED = False
+_TIMING_TRACE = False
+# log-scale histogram: 8 bins per octave (~9% resolution) from 1ns to 2**48ns (~3 days)
+_TIMER_BINS_PER_OCTAVE = 8
+_TIMER_NUM_BINS = 48 * _TIMER_BINS_PER_OCTAVE + 1
+
+
+def _ns_to_bin(ns):
+    if ns <= 1:
+        return 0
+    return min(int(math.log2(ns) * _TIMER_BINS_PER_OCTAVE), _TIMER_NUM_BINS - 1)
+
+
+class TimerStat(object):
+    # stats of one timer name, the histogram is preallocated, so recording never allocates
+    __slots__ = ('name', 'count', 'total_ns', 'min_ns', 'max_ns', 'hist')
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+        self.hist = [0] * _TIMER_NUM_BINS
+
+    def add(self, ns):
+        self.count += 1
+        self.total_ns += ns
+        if self.min_ns is None or ns < self.min_ns:
+            self.min_ns = ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        self.hist[_ns_to_bin(ns)] += 1
+
+    def percentile(self, q):
+        # q in [0, 100], the geometric center of the bin, clipped to the observed [min, max]
+        if self.count == 0:
+            return 0.
+        cum = np.cumsum(self.hist)
+        idx = int(np.searchsorted(cum, q / 100. * self.count))
+        value = 2 ** ((idx + 0.5) / _TIMER_BINS_PER_OCTAVE) if idx > 0 else 1.
+        return float(min(max(value, self.min_ns), self.max_ns))
+
+    def summary(self):
+        return collections.OrderedDict([
+            ('count', self.count),
+            ('total_ms', self.total_ns / 1e6),
+            ('mean_ms', self.total_ns / self.count / 1e6 if self.count else 0.),
+            ('p50_ms', self.percentile(50) / 1e6),
+            ('p95_ms', self.percentile(95) / 1e6),
+            ('p99_ms', self.percentile(99) / 1e6),
+            ('max_ms', self.max_ns / 1e6),
+        ])
+
+
+class TimerRegistry(object):
+    def __init__(self, trace_capacity=1000000):
+        self.stats = {}
+        self._lock = threading.Lock()
+        # (name, start_ns, dur_ns, thread id) of the latest calls when tracing, for the chrome trace
+        self.trace_events = collections.deque(maxlen=trace_capacity)
+        self._reporter = None
+
+    def get_stat(self, name):
+        stat = self.stats.get(name)
+        if stat is None:
+            with self._lock:
+                stat = self.stats.setdefault(name, TimerStat(name))
+        return stat
+
+    def record(self, name, start_ns, dur_ns):
+        self.get_stat(name).add(dur_ns)
+        if _TIMING_TRACE:
+            self.trace_events.append((name, start_ns, dur_ns, threading.get_ident()))
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+        self.trace_events.clear()
+
+    def summary(self):
+        return collections.OrderedDict((name, self.stats[name].summary()) for name in sorted(self.stats))
+
+    def format_report(self):
+        # slowest (by total time) first, the per-call columns are in us
+        lines = [f'{"name":<40s}{"count":>10s}{"total(ms)":>12s}{"mean(us)":>12s}{"p50(us)":>12s}{"p95(us)":>12s}'
+                 f'{"p99(us)":>12s}{"max(us)":>12s}']
+        for name, s in sorted(self.summary().items(), key=lambda x: -x[1]['total_ms']):
+            per_call = ''.join(f'{s[k] * 1e3:>12.1f}' for k in ['mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'])
+            lines.append(f'{name:<40s}{s["count"]:>10d}{s["total_ms"]:>12.2f}{per_call}')
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, path):
+        # chrome trace event format, complete events ("ph": "X") in us
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'ts': start_ns / 1e3, 'dur': dur_ns / 1e3, 'pid': pid, 'tid': tid}
+                  for name, start_ns, dur_ns, tid in list(self.trace_events)]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+
+_timer_registry = TimerRegistry()
+
+
+def enable_timing(trace=False):
+    # trace: also keep every call for `export_chrome_trace`
+    global _TIMING_ENABLED, _TIMING_TRACE
+    _TIMING_ENABLED = True
+    _TIMING_TRACE = trace
+
+
+def disable_timing():
+    global _TIMING_ENABLED, _TIMING_TRACE
+    _TIMING_ENABLED = False
+    _TIMING_TRACE = False
+
+
+def is_timing_enabled():
+    return _TIMING_ENABLED
+
+
+class _Timer(object):
+    __slots__ = ('name', 'start_ns')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _timer_registry.record(self.name, self.start_ns, time.perf_counter_ns() - self.start_ns)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    # `with timer('name'):`, a shared no-op context manager when timing is disabled
+    if not _TIMING_ENABLED:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def timed(name=None):
+    # decorator, `@timed` (named by the function qualname) or `@timed('name')`
+    def decorator(func, timer_name):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _TIMING_ENABLED:
+                return func(*args, **kwargs)
+            start_ns = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _timer_registry.record(timer_name, start_ns, time.perf_counter_ns() - start_ns)
+        return wrapper
+
+    if callable(name):
+        return decorator(name, f'{name.__module__}.{name.__qualname__}')
+    return lambda func: decorator(func, name or f'{func.__module__}.{func.__qualname__}')
+
+
+def get_timing_stats():
+    # {name: {count, total_ms, mean_ms, p50_ms, p95_ms, p99_ms, max_ms}}
+    return _timer_registry.summary()
+
+
+def reset_timing():
+    _timer_registry.reset()
+
+
+def format_timing_report():
+    return _timer_registry.format_report()
+
+
+def export_chrome_trace(path):
+    return _timer_registry.export_chrome_trace(path)
+
+
+def _get_timing_logger(logger):
+    if logger is None or isinstance(logger, str):
+        logger_name = logger or 'cypy.timing'
+        if logger_name in EasyLoggerManager.get_logger_names():
+            return EasyLoggerManager.retrieve_logger(logger_name)
+        return EasyLoggerManager(logger_name).get_logger(level=logging.INFO, handler_singleton=True)
+    return logger
+
+
+def log_timing_report(logger=None):
+    # logger: a logger, or the name of an EasyLoggerManager logger. Defaults to 'cypy.timing'.
+    if _timer_registry.stats:
+        _get_timing_logger(logger).info('timing report:\n' + format_timing_report())
+
+
+def start_timing_reporter(interval=60, logger=None, reset=False):
+    # log the report every `interval` seconds in a daemon thread, reset: clear the stats after each report
+    stop_timing_reporter()
+    logger = _get_timing_logger(logger)
+    stop_event = threading.Event()
+
+    def loop():
+        while not stop_event.wait(interval):
+            log_timing_report(logger)
+            if reset:
+                _timer_registry.reset()
+
+    thread = threading.Thread(target=loop, name='cypy-timing-reporter', daemon=True)
+    thread.start()
+    _timer_registry._reporter = (thread, stop_event)
+    return thread
+
+
+def stop_timing_reporter():
+    if _timer_registry._reporter is not None:
+        thread, stop_event = _timer_registry._reporter
+        stop_event.set()
+        thread.join()
+        _timer_registry._reporter = None
+
+
 if __name__ == "__main__":
     warning_prompt('This is a test')
     print('here')
\ No newline at end of file
@@ -1,9 +1,25 @@
+import copy
+import json
+import time
+import contextlib
+import collections
+
+from .time_utils import Duration
+
+
+def _to_number(x):
+    # tensor / numpy scalar -> python number, this is where a cuda tensor syncs with the host
+    return x.item() if hasattr(x, 'item') else x
 
 
 class AverageMeter(object):
     """Computes and stores the average and current value.
  
         Code imported from https://github.com/pytorch/examples/blob/master/imagenet/main.py#L247-L262
+
+    Tensor values are accumulated as float64 tensors on their own device (no `.item()` per step, and no precision loss
+    of fp16/bf16 sums over long runs), and are only converted to python numbers when `val` / `sum` / `avg` / `__str__` is read. Use `torch_utils.reduce_meters` to get copies of
+    the meters synced across ranks in one collective.
     """
  
     def __init__(self, name='metric', fmt=':f', sep=": "):
@@ -13,43 +29,294 @@ class AverageMeter(object):
         self.reset()
  
     def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
+        self._val = 0
+        self._sum = 0
         self.count = 0
  
     def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
+        if hasattr(val, 'detach'):  # torch tensor, keep it on device, in float64 so that the window/EMA state is too
+            val = val.detach().double()
+        self._val = val
+        self._sum = self._sum + val * n
         self.count += n
+
+    @property
+    def val(self):
+        self._val = _to_number(self._val)
+        return self._val
+
+    @property
+    def sum(self):
+        # cache the converted value, later updates keep accumulating on it
+        self._sum = _to_number(self._sum)
+        return self._sum
+
+    @property
+    def avg(self):
         if self.count == 0:
-           self.avg = self.sum / (self.count + 1e-12)
-        else:
-           self.avg = self.sum / self.count
- 
+            return self.sum / (self.count + 1e-12)
+        return self.sum / self.count
+
+    def _dist_state(self):
+        # sufficient statistics summed across ranks by `torch_utils.reduce_meters`
+        return [self._sum, self.count]
+
+    def _load_dist_state(self, state):
+        self._sum, self.count = state[0], int(round(_to_number(state[1])))
+
+    def _synced_copy(self, state):
+        # a copy holding the statistics reduced across ranks, the local statistics of self are kept untouched
+        meter = copy.copy(self)
+        meter._load_dist_state(state)
+        return meter
+
     def __str__(self):
         fmtstr = '{name}{sep}{val' + self.fmt + '} ({avg' + self.fmt + '})'
-        return fmtstr.format(**self.__dict__)
-   
+        return fmtstr.format(name=self.name, sep=self.sep, val=self.val, avg=self.avg)
+
+
+class WindowAverageMeter(AverageMeter):
+    """`avg` is the average of the last `window_size` updates, `global_avg` is the average of all the updates.
+    """
+
+    def __init__(self, name='metric', fmt=':f', sep=": ", window_size=20):
+        assert window_size > 0, f'window_size must be positive, but got {window_size}'
+        self.window_size = window_size
+        super(WindowAverageMeter, self).__init__(name=name, fmt=fmt, sep=sep)
+
+    def reset(self):
+        super(WindowAverageMeter, self).reset()
+        self._window = collections.deque(maxlen=self.window_size)
+
+    def update(self, val, n=1):
+        super(WindowAverageMeter, self).update(val, n)
+        self._window.append((self._val * n, n))
+
+    def _window_state(self):
+        # summed on device, only the result is converted
+        return sum(v for v, _ in self._window), sum(n for _, n in self._window)
+
+    @property
+    def avg(self):
+        total, count = self._window_state()
+        return _to_number(total) / (count if count else 1e-12)
+
+    @property
+    def global_avg(self):
+        return AverageMeter.avg.fget(self)
+
+    def _dist_state(self):
+        return list(self._window_state()) + super(WindowAverageMeter, self)._dist_state()
+
+    def _load_dist_state(self, state):
+        # the window is replaced by one entry of the global window stats, a new deque so that a copy does not share it
+        self._window = collections.deque([(state[0], int(round(_to_number(state[1]))))], maxlen=self.window_size)
+        super(WindowAverageMeter, self)._load_dist_state(state[2:])
+
+
+class EMAMeter(AverageMeter):
+    """`avg` is the exponential moving average of the updated values: avg = momentum * avg + (1 - momentum) * val,
+    initialized with the first value. `global_avg` is the average of all the updates.
+    """
+
+    def __init__(self, name='metric', fmt=':f', sep=": ", momentum=0.9):
+        assert 0 <= momentum < 1, f'momentum must be in [0, 1), but got {momentum}'
+        self.momentum = momentum
+        super(EMAMeter, self).__init__(name=name, fmt=fmt, sep=sep)
+
+    def reset(self):
+        super(EMAMeter, self).reset()
+        self._ema = None
+
+    def update(self, val, n=1):
+        super(EMAMeter, self).update(val, n)
+        if self._ema is None:
+            self._ema = self._val
+        else:
+            self._ema = self._ema * self.momentum + self._val * (1 - self.momentum)
+
+    @property
+    def avg(self):
+        if self._ema is None:
+            return 0
+        self._ema = _to_number(self._ema)
+        return self._ema
+
+    @property
+    def global_avg(self):
+        return AverageMeter.avg.fget(self)
+
+    def _dist_state(self):
+        # the ema of each rank is weighted by its count, ranks without any update do not count
+        return [self._ema * self.count if self._ema is not None else 0] + super(EMAMeter, self)._dist_state()
+
+    def _load_dist_state(self, state):
+        super(EMAMeter, self)._load_dist_state(state[1:])
+        self._ema = state[0] / self.count if self.count else None
+
 
 class ProgressMeter(object):
-    def __init__(self, num_batches, meters, prefix=""):
-       self.batch_fmtstr = self._get_batch_fmtstr(num_batches)
-       self.meters = meters
-       self.prefix = prefix
-      
+    """Format the batch index and the meters, and optionally time the training loop.
+
+    Timing (all optional, `display` only shows the timers that have been used):
+        - `mark(phase)`: attribute the time since the last mark (or step start) to `phase`, e.g. 'data' right after
+          the batch comes out of the loader, 'compute' after the optimizer step.
+        - `with pm.phase(name):` time a block.
+        - `step(num_samples)`: end the current step, update the rolling throughput, the EMA of the step time for the
+          ETA, and append a record to `jsonl_path` if given.
+
+    e.g.:
+    pm = ProgressMeter(len(loader), [loss_meter], prefix='Train: ', jsonl_path='timing.jsonl')
+    pm.start()
+    for i, (x, y) in enumerate(loader):
+        pm.mark('data')
+        ...
+        pm.mark('compute')
+        pm.step(x.shape[0])
+        if i % 10 == 0:
+            print(pm.display(i))
+
+    Args:
+        window_size (int): number of recent steps for the throughput and the phase times. Defaults to 50.
+        ema_momentum (float): momentum of the EMA of the step time used for the ETA. Defaults to 0.9.
+        jsonl_path (str || None): append one json line of timings per step. Defaults to None.
+    """
+
+    def __init__(self, num_batches, meters, prefix="", window_size=50, ema_momentum=0.9, jsonl_path=None):
+        self.num_batches = num_batches
+        self.batch_fmtstr = self._get_batch_fmtstr(num_batches)
+        self.meters = meters
+        self.prefix = prefix
+        self.window_size = window_size
+        self.ema_momentum = ema_momentum
+        self.jsonl_path = jsonl_path
+        self._jsonl_file = None
+        self.reset_timers()
+
+    def reset_timers(self):
+        self.steps_done = 0
+        self.ema_step_ns = None
+        # (step_ns, num_samples, {phase: ns}) of the recent steps
+        self._window = collections.deque(maxlen=self.window_size)
+        self._cur_phases = collections.OrderedDict()
+        self._step_start_ns = None
+        self._last_mark_ns = None
+
+    def start(self):
+        # start timing the first step, otherwise it starts at the first `mark` / `phase` / `step` call
+        self._step_start_ns = self._last_mark_ns = time.perf_counter_ns()
+        return self
+
+    def _now(self):
+        now = time.perf_counter_ns()
+        if self._step_start_ns is None:
+            self._step_start_ns = self._last_mark_ns = now
+        return now
+
+    def mark(self, phase):
+        now = self._now()
+        self._cur_phases[phase] = self._cur_phases.get(phase, 0) + now - self._last_mark_ns
+        self._last_mark_ns = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self._now()
+        tic = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            toc = time.perf_counter_ns()
+            self._cur_phases[name] = self._cur_phases.get(name, 0) + toc - tic
+            self._last_mark_ns = toc
+
+    def step(self, num_samples=1):
+        now = self._now()
+        step_ns = now - self._step_start_ns
+        phases = self._cur_phases
+        self._window.append((step_ns, num_samples, phases))
+        self.steps_done += 1
+        if self.ema_step_ns is None:
+            self.ema_step_ns = step_ns
+        else:
+            self.ema_step_ns = self.ema_momentum * self.ema_step_ns + (1 - self.ema_momentum) * step_ns
+        self._cur_phases = collections.OrderedDict()
+        self._step_start_ns = self._last_mark_ns = now
+        if self.jsonl_path:
+            self._write_record(step_ns, num_samples, phases)
+
+    @property
+    def throughput(self):
+        # samples / sec over the recent steps
+        total_ns = sum(x[0] for x in self._window)
+        return sum(x[1] for x in self._window) * 1e9 / total_ns if total_ns else 0.
+
+    @property
+    def eta_seconds(self):
+        if self.ema_step_ns is None:
+            return None
+        return max(self.num_batches - self.steps_done, 0) * self.ema_step_ns / 1e9
+
+    def phase_times(self):
+        # average ms per step of each phase over the recent steps
+        totals = collections.OrderedDict()
+        for _, _, phases in self._window:
+            for name, ns in phases.items():
+                totals[name] = totals.get(name, 0) + ns
+        return collections.OrderedDict((k, v / len(self._window) / 1e6) for k, v in totals.items())
+
+    def _write_record(self, step_ns, num_samples, phases):
+        if self._jsonl_file is None:
+            self._jsonl_file = open(self.jsonl_path, 'a', buffering=1)
+        record = {'step': self.steps_done, 'time': time.time(), 'step_ms': step_ns / 1e6, 'samples': num_samples,
+                  'throughput': self.throughput, 'eta_s': self.eta_seconds}
+        record.update({f'{k}_ms': v / 1e6 for k, v in phases.items()})
+        self._jsonl_file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self._jsonl_file is not None:
+            self._jsonl_file.close()
+            self._jsonl_file = None
+
     def display(self, batch):
-       entries = [self.prefix + self.batch_fmtstr.format(batch)]
-       entries += [str(meter) for meter in self.meters]
-       return '  '.join(entries)
-      
+        entries = [self.prefix + self.batch_fmtstr.format(batch)]
+        entries += [str(meter) for meter in self.meters]
+        if self._window:
+            step_ms = sum(x[0] for x in self._window) / len(self._window) / 1e6
+            phase_times = self.phase_times()
+            entries += [f'{k}: {v:.1f}ms' for k, v in phase_times.items()]
+            entries.append(f'step: {step_ms:.1f}ms')
+            # the share of the step spent waiting for data, a high value means the input pipeline stalls
+            if 'data' in phase_times and step_ms > 0:
+                entries.append(f'data_wait: {phase_times["data"] / step_ms * 100:.0f}%')
+            entries.append(f'{self.throughput:.1f} samples/s')
+            entries.append(f'ETA: {Duration(int(self.eta_seconds))}')
+        return '  '.join(entries)
+
     def _get_batch_fmtstr(self, num_batches):
-       num_digits = len(str(num_batches // 1))
-       fmt = '{:' + str(num_digits) + 'd}'
-       return '[' + fmt + '/' + fmt.format(num_batches) + ']'
+        num_digits = len(str(num_batches // 1))
+        fmt = '{:' + str(num_digits) + 'd}'
+        return '[' + fmt + '/' + fmt.format(num_batches) + ']'
+
+
+def _check_low_precision():
+    # sums of fp16/bf16/fp32 tensors must not lose precision over many updates
+    import torch
+    for dtype in [torch.bfloat16, torch.float16, torch.float32]:
+        val = torch.tensor(2.3, dtype=dtype)
+        meters = [AverageMeter(), WindowAverageMeter(window_size=100), EMAMeter()]
+        for _ in range(20000):
+            for meter in meters:
+                meter.update(val, n=64)
+        expected = float(val.double())
+        for meter in meters:
+            for avg in [meter.avg, getattr(meter, 'global_avg', meter.avg)]:
+                assert abs(avg - expected) < 1e-9, f'{type(meter).__name__} {dtype}: {avg} vs {expected}'
+    print('low precision accumulation: ok')
 
 
 if __name__ == "__main__":
+    _check_low_precision()
+
     meter = AverageMeter('TrainACC', ":.2f", ": ")
     pm = ProgressMeter(100, [meter], prefix="Test: ")
     meter.update(1)
@@ -58,4 +325,16 @@ if __name__ == "__main__":
     print(pm.display(2))
     meter.update(1)
 
+    pm = ProgressMeter(20, [meter], prefix="Train: ")
+    pm.start()
+    for i in range(20):
+        time.sleep(0.01)  # data
+        pm.mark('data')
+        with pm.phase('compute'):
+            time.sleep(0.02)
+        meter.update(i)
+        pm.step(32)
+        if i % 5 == 0:
+            print(pm.display(i))
+
    # print(meter)
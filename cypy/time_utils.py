@@ -1,6 +1,19 @@
 from calendar import monthrange
 from datetime import datetime
 
+import numpy as np
+
+
+def _format_subsecond(subsecond):
+    # the `.xx` suffix of a non-zero `subsecond` (already rounded to 2 digits), shared by `Duration` and `format_durations`
+    subsecond_digit_len = len(str(subsecond)) - 2
+    subsecond_digit_num = int(subsecond * (10 ** subsecond_digit_len))
+    subsecond_digit_str = str(subsecond_digit_num)[:2]
+    if len(subsecond_digit_str) < 2:
+        subsecond_digit_str = subsecond_digit_str + '0'
+    return subsecond_digit_len, subsecond_digit_num, subsecond_digit_str
+
+
 class Duration(object):
     '''
     d1 = Duration(1234)
@@ -11,7 +24,12 @@ class Duration(object):
     d1 += 1
 
     d3 = Duration(1234.54)
+
+    For many values, use `format_durations` / `parse_durations` instead.
     '''
+    __slots__ = ('duration', 'hour', 'miniute', 'second', 'subsecond', 'subsecond_digit_len', 'subsecond_digit_num',
+                 'subsecond_digit_str', 'data_str')
+
     def __init__(self, duration):
         assert isinstance(duration, int) or isinstance(duration, float)
         # assert duration < 86400, f'duration should be less than 1 day.'
@@ -29,11 +47,7 @@ class Duration(object):
         if self.subsecond == 0:
             self.data_str = f'{self.hour:02d}:{self.miniute:02d}:{self.second:02d}'
         else:
-            self.subsecond_digit_len = len(str(self.subsecond)) - 2
-            self.subsecond_digit_num = int(self.subsecond * (10 ** self.subsecond_digit_len))
-            self.subsecond_digit_str = str(self.subsecond_digit_num)[:2]
-            if len(self.subsecond_digit_str) < 2:
-                self.subsecond_digit_str = self.subsecond_digit_str + '0'
+            self.subsecond_digit_len, self.subsecond_digit_num, self.subsecond_digit_str = _format_subsecond(self.subsecond)
             self.data_str = f'{self.hour:02d}:{self.miniute:02d}:{self.second:02d}.{self.subsecond_digit_str}'
         return self.data_str
 
@@ -56,6 +70,67 @@ class Duration(object):
         return self
 
 
+def _build_subsecond_suffixes():
+    # suffix of each rounded subsecond k / 100, k in [0, 100] (100 when e.g. 0.999 is rounded to 1.0)
+    suffixes = ['']
+    for k in range(1, 101):
+        suffixes.append('.' + _format_subsecond(round(k / 100, 2))[2])
+    return np.array(suffixes)
+
+
+_SUBSECOND_SUFFIXES = _build_subsecond_suffixes()
+_TWO_DIGITS = np.array([f'{i:02d}' for i in range(100)])
+
+
+def format_durations(durations):
+    """Vectorized `Duration.__repr__`: format an array of durations (seconds) to `HH:MM:SS[.xx]` strings,
+    exactly the same as `str(Duration(x))` for each value. Return a numpy array of str.
+    """
+    d = np.asarray(durations, dtype=np.float64)
+    # same float ops as `Duration.reformat`
+    hour = np.floor_divide(d, 3600)
+    miniute = np.floor_divide(d - hour * 3600, 60)
+    second = np.trunc(d - hour * 3600 - miniute * 60)
+    frac = d - hour * 3600 - miniute * 60 - second
+
+    # round(frac, 2) * 100, python rounds the exact binary value, frac * 100 may only differ from it near x.5
+    scaled = frac * 100
+    k = np.rint(scaled)
+    near_half = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_half.any():
+        k[near_half] = [round(round(float(x), 2) * 100) for x in frac[near_half]]
+    k = k.astype(np.int64)
+
+    hour, miniute, second = hour.astype(np.int64), miniute.astype(np.int64), second.astype(np.int64)
+    if (hour >= 0).all() and (hour < 100).all():
+        hour_str = _TWO_DIGITS[hour]
+    else:
+        hour_str = np.array([f'{h:02d}' for h in hour.ravel().tolist()]).reshape(hour.shape)
+    out = np.char.add(np.char.add(hour_str, ':'), _TWO_DIGITS[miniute])
+    out = np.char.add(np.char.add(out, ':'), _TWO_DIGITS[second])
+    return np.char.add(out, _SUBSECOND_SUFFIXES[k])
+
+
+def parse_durations(duration_strs):
+    """Parse `[-]HH:MM:SS[.fraction]` strings (Duration / ffmpeg timestamps) to a float64 array of seconds.
+    All the fields are converted in one pass by numpy instead of one split / float() per string.
+    """
+    duration_strs = list(duration_strs)
+    if not duration_strs:
+        return np.zeros(0, dtype=np.float64)
+    strs = np.char.strip(np.array(duration_strs, dtype=str))
+    # a leading sign applies to the whole duration, e.g. ffmpeg `time=-00:00:01.00`
+    negative = np.char.startswith(strs, '-')
+    strs = np.where(negative | np.char.startswith(strs, '+'), np.char.lstrip(strs, '+-'), strs)
+    # each string must have exactly 3 fields, otherwise fields of different strings would be regrouped silently
+    bad = (np.char.count(strs, ':') != 2) | (np.char.count(strs, ' ') != 0) | (np.char.find(strs, '::') != -1) | \
+          np.char.startswith(strs, ':') | np.char.endswith(strs, ':')
+    assert not bad.any(), f'All the durations must be in the format of [-]HH:MM:SS[.fraction], but got {duration_strs[int(np.argmax(bad))]!r}'
+    fields = np.array(' '.join(strs.tolist()).replace(':', ' ').split(), dtype=np.float64).reshape(-1, 3)
+    seconds = fields[:, 0] * 3600 + fields[:, 1] * 60 + fields[:, 2]
+    return np.where(negative, -seconds, seconds)
+
+
 def date_format_check(date_str):
     '''
     func:
@@ -1,3 +1,9 @@
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
 import torch.distributed as dist
 
@@ -10,38 +16,552 @@ def reduce_tensor(tensor, mean=True):
     return rt
 
 
-def gather_tensor(inp, world_size, dist_=False, to_numpy=False):
-    inp = torch.stack(inp)
+def is_dist_ready():
+    return dist.is_available() and dist.is_initialized()
+
+
+def _flatten_nested(obj, tensors, objects):
+    # split a nested structure into tensor leaves, non-tensor leaves and a spec to rebuild it
+    if isinstance(obj, torch.Tensor):
+        tensors.append(obj)
+        return ('tensor', len(tensors) - 1)
+    if isinstance(obj, dict):
+        return ('dict', type(obj), [(k, _flatten_nested(v, tensors, objects)) for k, v in obj.items()])
+    if isinstance(obj, (list, tuple)):
+        return ('seq', type(obj), [_flatten_nested(v, tensors, objects) for v in obj])
+    objects.append(obj)
+    return ('object', len(objects) - 1)
+
+
+def _unflatten_nested(spec, tensors, objects):
+    kind = spec[0]
+    if kind == 'tensor':
+        return tensors[spec[1]]
+    if kind == 'object':
+        return objects[spec[1]]
+    if kind == 'dict':
+        return spec[1]((k, _unflatten_nested(v, tensors, objects)) for k, v in spec[2])
+    values = [_unflatten_nested(v, tensors, objects) for v in spec[2]]
+    if hasattr(spec[1], '_fields'):  # namedtuple
+        return spec[1](*values)
+    return spec[1](values)
+
+
+_ALL_GATHER_INTO_TENSOR = {}
+
+
+def _all_gather_flat(flat, world_size, group=None):
+    # all_gather a 1-D tensor of the same length on every rank into one (world_size * len) tensor.
+    # `all_gather_into_tensor` writes into a single preallocated output instead of a list of world_size tensors,
+    # fall back to the list version on torch/backends that do not support it.
+    out = flat.new_empty(world_size * flat.numel())
+    backend = dist.get_backend(group)
+    if _ALL_GATHER_INTO_TENSOR.get(backend, hasattr(dist, 'all_gather_into_tensor')):
+        try:
+            dist.all_gather_into_tensor(out, flat, group=group)
+            _ALL_GATHER_INTO_TENSOR[backend] = True
+            return out
+        except (RuntimeError, NotImplementedError):
+            _ALL_GATHER_INTO_TENSOR[backend] = False
+    dist.all_gather(list(out.chunk(world_size)), flat, group=group)
+    return out
+
+
+def gather_variable(obj, group=None, cat=True):
+    """all_gather an arbitrary nested structure (dict / list / tuple / namedtuple) of tensors whose shapes may differ
+    across ranks, e.g. the uneven last batch. Return the same structure, where each tensor leaf is the gathered
+    result in rank order, and each non-tensor leaf is the list of values of all ranks.
+
+    The collectives do not depend on the number of leaves:
+        1. one all_gather of the leaf shapes (sizes first);
+        2. per dtype, the leaves are packed into one flat bucket, padded to the max bucket size once,
+           gathered with `all_gather_into_tensor`, then the padding is stripped and the leaves are unpacked;
+        3. one `all_gather_object` only if there are non-tensor leaves (object fallback).
+    The structure (number of leaves, their dtypes and ndims) must be the same on every rank.
+
+    Args:
+        cat (bool): concat the tensor leaves of all ranks along dim 0 (0-dim tensors are stacked).
+            If False, or the trailing dims differ across ranks, each leaf is a list of per-rank tensors. Defaults to True.
+    """
+    tensors, objects = [], []
+    spec = _flatten_nested(obj, tensors, objects)
+    if not is_dist_ready() or not tensors:
+        world_size = 1 if not is_dist_ready() else dist.get_world_size(group)
+        gathered = [[t] for t in tensors]
+        gathered_objects = [[o] for o in objects]
+        if objects and world_size > 1:
+            all_objects = [None] * world_size
+            dist.all_gather_object(all_objects, objects, group=group)
+            gathered_objects = [[all_objects[r][i] for r in range(world_size)] for i in range(len(objects))]
+    else:
+        world_size = dist.get_world_size(group)
+        device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend(group) == 'nccl' else torch.device('cpu')
+
+        # 1. exchange the shapes of all leaves: [ndim, *shape] of each leaf, concatenated
+        meta = torch.tensor([v for t in tensors for v in (t.dim(),) + tuple(t.shape)], dtype=torch.int64, device=device)
+        all_meta = _all_gather_flat(meta, world_size, group=group).view(world_size, -1).tolist()
+        all_shapes = []
+        for rank_meta in all_meta:
+            shapes, pos = [], 0
+            for _ in tensors:
+                ndim = rank_meta[pos]
+                shapes.append(torch.Size(rank_meta[pos + 1:pos + 1 + ndim]))
+                pos += 1 + ndim
+            all_shapes.append(shapes)
+
+        # 2. one padded bucket per dtype
+        gathered = [[None] * world_size for _ in tensors]
+        buckets = {}
+        for i, t in enumerate(tensors):
+            buckets.setdefault(t.dtype, []).append(i)
+        for dtype, leaf_ids in buckets.items():
+            # gloo/nccl can not gather bool
+            comm_dtype = torch.uint8 if dtype == torch.bool else dtype
+            numels = [sum(all_shapes[r][i].numel() for i in leaf_ids) for r in range(world_size)]
+            max_numel = max(max(numels), 1)
+            flat = torch.zeros(max_numel, dtype=comm_dtype, device=device)
+            local = [tensors[i].detach().reshape(-1).to(device=device, dtype=comm_dtype) for i in leaf_ids]
+            if local:
+                local = torch.cat(local)
+                flat[:local.numel()] = local
+            out = _all_gather_flat(flat, world_size, group=group).view(world_size, max_numel)
+            for r in range(world_size):
+                offset = 0
+                for i in leaf_ids:
+                    shape = all_shapes[r][i]
+                    gathered[i][r] = out[r, offset:offset + shape.numel()].view(shape).to(dtype)
+                    offset += shape.numel()
+
+        # 3. object fallback for non-tensor leaves
+        gathered_objects = [[] for _ in objects]
+        if objects:
+            all_objects = [None] * world_size
+            dist.all_gather_object(all_objects, objects, group=group)
+            gathered_objects = [[all_objects[r][i] for r in range(world_size)] for i in range(len(objects))]
+
+    results = []
+    for parts in gathered:
+        if cat and parts[0].dim() == 0:
+            results.append(torch.stack(parts))
+        elif cat and all(p.shape[1:] == parts[0].shape[1:] for p in parts):
+            results.append(torch.cat(parts))
+        else:
+            results.append(parts)
+    return _unflatten_nested(spec, results, gathered_objects)
+
+
+def all_gather_variable(tensor, group=None):
+    # all_gather tensors whose dim 0 differs across ranks, return the concatenated tensor in rank order
+    return gather_variable(tensor, group=group)
+
+
+def gather_tensor(inp, world_size=None, dist_=False, to_numpy=False, group=None):
+    """Gather the per-step outputs of all ranks.
+
+    Args:
+        inp (list[Tensor] || Tensor || nested structure): a list of same-shape tensors is stacked first (the old
+            behavior), other inputs are passed to `gather_variable` as they are, so the per-rank shapes can differ.
+        world_size: kept for backward compatibility, the world size of `group` is used.
+    """
+    if isinstance(inp, (list, tuple)) and all(isinstance(x, torch.Tensor) for x in inp) and \
+            all(x.shape == inp[0].shape for x in inp):
+        inp = torch.stack(inp)
     if dist_:
-        gather_inp = [torch.ones_like(inp) for _ in range(world_size)]
-        dist.all_gather(gather_inp, inp)
-        gather_inp = torch.cat(gather_inp)
+        gather_inp = gather_variable(inp, group=group)
     else:
         gather_inp = inp
-    
+
     if to_numpy:
         gather_inp = gather_inp.cpu().numpy()
-    
+
     return gather_inp
 
 
+def all_reduce_arrays(arrays, group=None):
+    """Sum a list of numpy arrays over all ranks with one `all_reduce`, by packing them into a single flat buffer.
+    int arrays are reduced as int64 and the others as float64, so counts stay exact.
+    Return a list of reduced numpy arrays with the same shapes. Without an initialized process group, return copies.
+    """
+    arrays = [np.asarray(x) for x in arrays]
+    if not is_dist_ready():
+        return [x.copy() for x in arrays]
+    is_int = all(np.issubdtype(x.dtype, np.integer) or x.dtype == np.bool_ for x in arrays)
+    dtype = np.int64 if is_int else np.float64
+    flat = torch.from_numpy(np.concatenate([x.astype(dtype).ravel() for x in arrays]))
+    # nccl can only reduce cuda tensors
+    if dist.get_backend(group) == 'nccl':
+        flat = flat.cuda()
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM, group=group)
+    flat = flat.cpu().numpy()
+    out, offset = [], 0
+    for x in arrays:
+        out.append(flat[offset:offset + x.size].reshape(x.shape))
+        offset += x.size
+    return out
+
+
+class MetricReducer(object):
+    """Reduce many named scalars/tensors across ranks with one async `all_reduce` instead of one blocking
+    `reduce_tensor` per value. The values are packed into one flat float64 buffer, and the handle is only waited
+    when a value is read.
+
+    e.g.:
+    reducer = MetricReducer()
+    reducer.add('loss', loss)
+    reducer.add('acc', acc)
+    reducer.reduce()  # returns immediately
+    ...  # overlap with other work
+    print(reducer['loss'], reducer['acc'])  # waits here
+
+    Args:
+        mean (bool): divide the sums by the world size, same as `reduce_tensor`. Defaults to True.
+        group: process group, None for the default group.
+    """
+
+    def __init__(self, mean=True, group=None):
+        self.mean = mean
+        self.group = group
+        self.reset()
+
+    def reset(self):
+        self._values = collections.OrderedDict()
+        self._results = None
+        self._buffer = None
+        self._handle = None
+
+    def add(self, name, value):
+        assert self._buffer is None, 'Can not add values after reduce(), call reset() first'
+        self._values[name] = value
+        return self
+
+    def __setitem__(self, name, value):
+        self.add(name, value)
+
+    def update(self, values):
+        for name, value in values.items():
+            self.add(name, value)
+        return self
+
+    def reduce(self):
+        # issue the all_reduce of all the added values, non-blocking
+        if self._buffer is not None or not self._values:
+            return self
+        tensors = [v for v in self._values.values() if isinstance(v, torch.Tensor)]
+        if is_dist_ready() and dist.get_backend(self.group) == 'nccl':
+            device = torch.device('cuda', torch.cuda.current_device())
+        else:
+            device = tensors[0].device if tensors else torch.device('cpu')
+        # python numbers are packed together by one host to device copy, the tensors stay on device (no sync)
+        numbers = [float(v) for v in self._values.values() if not isinstance(v, torch.Tensor)]
+        parts = [t.detach().reshape(-1).to(device=device, dtype=torch.float64) for t in tensors]
+        if numbers:
+            parts.append(torch.tensor(numbers, dtype=torch.float64, device=device))
+        self._buffer = torch.cat(parts)
+        if is_dist_ready():
+            self._handle = dist.all_reduce(self._buffer, op=dist.ReduceOp.SUM, group=self.group, async_op=True)
+        return self
+
+    def _resolve(self):
+        if self._results is not None:
+            return self._results
+        if not self._values:
+            if is_dist_ready():
+                # the other ranks would wait for an all_reduce this rank never joins
+                raise KeyError('No value was added to MetricReducer, the same keys must be added on all ranks before reading')
+            self._results = {}
+            return self._results
+        self.reduce()
+        if self._handle is not None:
+            self._handle.wait()
+        buffer = self._buffer
+        if self.mean and is_dist_ready():
+            buffer = buffer / dist.get_world_size(self.group)
+        tensor_names = [k for k, v in self._values.items() if isinstance(v, torch.Tensor)]
+        number_names = [k for k, v in self._values.items() if not isinstance(v, torch.Tensor)]
+        self._results, offset = {}, 0
+        for name in tensor_names:
+            value = self._values[name]
+            reduced = buffer[offset:offset + value.numel()].view(value.shape)
+            # keep float dtypes, ints become float64 when averaged
+            self._results[name] = reduced if self.mean and not value.is_floating_point() else reduced.to(value.dtype)
+            offset += value.numel()
+        if number_names:
+            for name, v in zip(number_names, buffer[offset:].tolist()):
+                self._results[name] = v
+        return self._results
+
+    def is_ready(self):
+        return self._handle is None or self._handle.is_completed()
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            raise KeyError(f'{name} was not added to MetricReducer, the same keys must be added on all ranks')
+        return self._resolve()[name]
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def keys(self):
+        return self._values.keys()
+
+    def items(self):
+        results = self._resolve()
+        return [(k, results[k]) for k in self._values]
+
+    def as_dict(self, to_float=False):
+        # to_float: convert single-element tensors to python floats (one host sync for all of them)
+        results = dict(self.items())
+        if to_float:
+            results = {k: v.item() if isinstance(v, torch.Tensor) and v.numel() == 1 else v for k, v in results.items()}
+        return results
+
+
+def reduce_meters(meters, group=None):
+    """Sync `progress_utils.AverageMeter` (and the window / EMA variants) across ranks with one `all_reduce`.
+    Returns copies of the meters holding the global statistics, the input meters keep their local statistics,
+    so it can be called any number of times (e.g. at every display) without double counting.
+    """
+    meters = list(meters)
+    if not is_dist_ready() or not meters:
+        return meters
+    reducer = MetricReducer(mean=False, group=group)
+    states = [meter._dist_state() for meter in meters]
+    for i, state in enumerate(states):
+        for j, value in enumerate(state):
+            # a meter without updates holds python numbers where the others hold tensors, pack everything as tensors
+            # so that the buffer layout is the same on all ranks
+            reducer.add((i, j), torch.as_tensor(value, dtype=torch.float64))
+    reducer.reduce()
+    return [meter._synced_copy([reducer[(i, j)] for j in range(len(state))]) for i, (meter, state) in enumerate(zip(meters, states))]
+
+
+class DistHistogramMetrics(object):
+    """`HistogramMetrics` across ranks. Each rank updates its local histograms, `compute` sums the histograms
+    (and the loss sums if any) with one `all_reduce`, so the communication is O(num_bins) instead of O(N).
+    Every rank gets the same metrics. Works with any backend, e.g. gloo on cpu.
+
+    The local histograms are a `HistogramMetrics` (`self.local`), other attributes (hist, num_bins, merge, ...) are
+    looked up on it. metric_utils (sklearn, scipy) is only imported when this class is used.
+
+    Args:
+        exact (bool): also keep the raw labels/scores, and compute the exact `cal_metrics` by a variable-length
+            all_gather instead (O(N) communication, the local memory also grows with N). Defaults to False.
+        group: process group, None for the default group.
+        the others are the same as `HistogramMetrics`.
+    """
+
+    def __init__(self, num_bins=10000, score_range=(0., 1.), pos_label=1, exact=False, group=None):
+        from .metric_utils import HistogramMetrics
+        self.exact = exact
+        self.group = group
+        self.local = HistogramMetrics(num_bins=num_bins, score_range=score_range, pos_label=pos_label)
+        self.reset()
+
+    def __getattr__(self, name):
+        # only called for attributes not found on self, `local` itself is excluded to avoid recursion (e.g. unpickling)
+        if name == 'local':
+            raise AttributeError(name)
+        return getattr(self.local, name)
+
+    def __len__(self):
+        return len(self.local)
+
+    def reset(self):
+        self.local.reset()
+        # [loss sum, num samples for loss]
+        self.loss_stats = np.zeros(2, dtype=np.float64)
+        self.y_trues, self.y_preds = [], []
+
+    def update(self, y_trues, y_preds, loss=None):
+        # loss: mean loss of this batch, weighted by the batch size when averaging
+        self.local.update(y_trues, y_preds)
+        if loss is not None:
+            n = len(self._to_numpy(y_preds))
+            self.loss_stats += [float(loss) * n, n]
+        if self.exact:
+            self.y_trues.append(self._to_numpy(y_trues))
+            self.y_preds.append(self._to_numpy(y_preds).astype(np.float64))
+        return self
+
+    def sync(self):
+        # return a plain `HistogramMetrics` holding the global histograms, and the global [loss sum, count]
+        global_meter = type(self.local)(num_bins=self.num_bins, score_range=self.score_range, pos_label=self.pos_label)
+        # packed as float64 together with the loss sums, counts are still exact below 2**53
+        hist, loss_stats = all_reduce_arrays([self.hist.astype(np.float64), self.loss_stats], group=self.group)
+        global_meter.hist = np.rint(hist).astype(np.int64)
+        return global_meter, loss_stats
+
+    def _gather_raw(self):
+        y_trues = np.concatenate(self.y_trues) if self.y_trues else np.zeros(0)
+        y_preds = np.concatenate(self.y_preds) if self.y_preds else np.zeros(0)
+        y_trues, y_preds = gather_variable((torch.from_numpy(y_trues.astype(np.float64)), torch.from_numpy(y_preds)),
+                                           group=self.group)
+        return y_trues.cpu().numpy(), y_preds.cpu().numpy()
+
+    def compute(self, threshold=0.5):
+        if self.exact:
+            from .metric_utils import cal_metrics
+            y_trues, y_preds = self._gather_raw()
+            y_trues = (y_trues == self.pos_label).astype(int)
+            metrics = cal_metrics(y_trues, y_preds, threshold=threshold)
+            loss_stats, = all_reduce_arrays([self.loss_stats], group=self.group)
+        else:
+            global_meter, loss_stats = self.sync()
+            metrics = global_meter.compute(threshold=threshold)
+        if loss_stats[1] > 0:
+            metrics.Loss = float(loss_stats[0] / loss_stats[1])
+        return metrics
+
+
 class Compose:
     """
     all kwargs for __call__ func.
+
+    Args:
+        timing (bool): accumulate the time spent in each transform, see `timing_report`. Defaults to False.
+        num_workers (int): threads used by `batch_call` to run the per-sample transforms of a batch, useful for
+            transforms that release the GIL (cv2, PIL resize, numpy). 0 runs them in the calling thread. Defaults to 0.
+
+    `batch_call(imgs, **kwargs)` applies the transforms to a batch (a list of samples, or a tensor / ndarray whose
+    first dim is the batch). A transform with a `batch_call` method gets the whole batch at once, consecutive
+    per-sample transforms are fused into one chain per sample (and one thread pool task per sample).
     """
 
-    def __init__(self, transforms_):
+    def __init__(self, transforms_, timing=False, num_workers=0):
         self.transforms_ = transforms_
+        self.timing = timing
+        self.num_workers = num_workers
+        self._pool = None
+        self._lock = threading.Lock()
+        self.reset_timing()
+
+    def reset_timing(self):
+        # per transform: [number of calls, total ns]
+        self._timing_stats = [[0, 0] for _ in self.transforms_]
+
+    def _record_timing(self, local_stats):
+        with self._lock:
+            for i, (calls, ns) in local_stats.items():
+                self._timing_stats[i][0] += calls
+                self._timing_stats[i][1] += ns
+
+    def _apply(self, tt, img, _func=None, **kwargs):
+        # _func: the callable to run instead of `tt` itself (e.g. tt.batch_call), errors still report the transform
+        try:
+            return (_func or tt)(img, **kwargs)
+        except:
+            print(f'ERROR in torch.utils.Compose (ComposeV2): {tt.__class__.__name__}')
+            raise
+
+    def _run_chain(self, img, start, end, **kwargs):
+        # apply transforms_[start:end] to one sample, return the sample and the timing of this call
+        local_stats = {}
+        for i in range(start, end):
+            if self.timing:
+                tic = time.perf_counter_ns()
+                img = self._apply(self.transforms_[i], img, **kwargs)
+                local_stats[i] = (1, time.perf_counter_ns() - tic)
+            else:
+                img = self._apply(self.transforms_[i], img, **kwargs)
+        return img, local_stats
 
     def __call__(self, img, **kwargs):
-        for tt in self.transforms_:
-            try:
-                img = tt(img, **kwargs)
-            except:
-                print(f'ERROR in torch.utils.Compose (ComposeV2): {tt.__class__.__name__}')
-                raise
+        img, local_stats = self._run_chain(img, 0, len(self.transforms_), **kwargs)
+        if local_stats:
+            self._record_timing(local_stats)
         return img
 
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.num_workers)
+        return self._pool
+
+    def batch_call(self, imgs, **kwargs):
+        if hasattr(imgs, 'detach'):
+            out_type = 'tensor'
+        elif isinstance(imgs, np.ndarray):
+            out_type = 'ndarray'
+        else:
+            out_type = 'list'
+        samples = None  # per-sample view of the batch, only split when a per-sample transform needs it
+
+        i = 0
+        while i < len(self.transforms_):
+            tt = self.transforms_[i]
+            if hasattr(tt, 'batch_call'):
+                if samples is not None:
+                    imgs, samples = self._collate(samples, out_type), None
+                tic = time.perf_counter_ns()
+                imgs = self._apply(tt, imgs, _func=tt.batch_call, **kwargs)
+                if self.timing:
+                    self._record_timing({i: (1, time.perf_counter_ns() - tic)})
+                i += 1
+                continue
+
+            # fuse the consecutive per-sample transforms
+            j = i
+            while j < len(self.transforms_) and not hasattr(self.transforms_[j], 'batch_call'):
+                j += 1
+            if samples is None:
+                samples = list(imgs)
+            if self.num_workers > 0 and len(samples) > 1:
+                results = list(self._get_pool().map(lambda x: self._run_chain(x, i, j, **kwargs), samples))
+            else:
+                results = [self._run_chain(x, i, j, **kwargs) for x in samples]
+            samples = [x for x, _ in results]
+            if self.timing:
+                merged = {}
+                for _, local_stats in results:
+                    for k, (calls, ns) in local_stats.items():
+                        c, n = merged.get(k, (0, 0))
+                        merged[k] = (c + calls, n + ns)
+                self._record_timing(merged)
+            i = j
+
+        if samples is not None:
+            imgs = self._collate(samples, out_type)
+        return imgs
+
+    @staticmethod
+    def _collate(samples, out_type):
+        if out_type == 'tensor':
+            return torch.stack(samples)
+        if out_type == 'ndarray':
+            return np.stack(samples)
+        return samples
+
+    def timing_stats(self):
+        # list of (transform name, calls, total ms, mean ms), in the order of the transforms
+        stats = []
+        for tt, (calls, ns) in zip(self.transforms_, self._timing_stats):
+            stats.append((tt.__class__.__name__, calls, ns / 1e6, ns / 1e6 / calls if calls else 0.))
+        return stats
+
+    def timing_report(self):
+        # slowest transforms first
+        stats = sorted(self.timing_stats(), key=lambda x: -x[2])
+        total = sum(x[2] for x in stats) or 1.
+        lines = [f'{"transform":<32s}{"calls":>10s}{"total(ms)":>14s}{"mean(ms)":>12s}{"share":>8s}']
+        for name, calls, total_ms, mean_ms in stats:
+            lines.append(f'{name:<32s}{calls:>10d}{total_ms:>14.2f}{mean_ms:>12.4f}{total_ms / total * 100:>7.1f}%')
+        return '\n'.join(lines)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __getstate__(self):
+        # picklable for DataLoader workers, each worker creates its own pool
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
     def __repr__(self):
         format_string = self.__class__.__name__ + '('
         for t in self.transforms_:
@@ -49,3 +569,96 @@ class Compose:
             format_string += '    {0}'.format(t)
         format_string += '\n)'
         return format_string
+
+
+def _demo_dist_metrics(rank, world_size, port):
+    from .metric_utils import cal_metrics
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    rng = np.random.RandomState(0)
+    y_trues = rng.randint(0, 2, 10000)
+    y_preds = np.clip(rng.normal(0.35 + 0.3 * y_trues, 0.15), 0, 1)
+    # uneven split over the ranks
+    splits = np.array_split(np.arange(len(y_trues)), [3000 * (i + 1) for i in range(world_size - 1)])
+    local_idx = splits[rank]
+
+    for exact in [False, True]:
+        meter = DistHistogramMetrics(exact=exact)
+        for idx in np.array_split(local_idx, 5):
+            meter.update(torch.from_numpy(y_trues[idx]), torch.from_numpy(y_preds[idx]), loss=1.)
+        metrics = meter.compute(threshold='auto')
+        if rank == 0:
+            print(f'exact={exact}:', {k: round(float(v), 5) for k, v in metrics.items()})
+    if rank == 0:
+        print('single process:', {k: round(float(v), 5) for k, v in cal_metrics(y_trues, y_preds, 'auto').items()})
+    dist.destroy_process_group()
+
+
+def _bench_gather(rank, world_size, port, repeat=20):
+    import time
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    batch = 256
+
+    def old_gather(inp):
+        # the previous gather_tensor: same shape on every rank, a list of buffers
+        gather_inp = [torch.ones_like(inp) for _ in range(world_size)]
+        dist.all_gather(gather_inp, inp)
+        return torch.cat(gather_inp)
+
+    def bench(name, func, *args):
+        dist.barrier()
+        tic = time.perf_counter()
+        for _ in range(repeat):
+            out = func(*args)
+        cost = (time.perf_counter() - tic) / repeat * 1000
+        if rank == 0:
+            print(f'{name:<48s}{cost:8.3f} ms')
+        return out
+
+    preds = torch.randn(batch, 1000)
+    bench('old gather_tensor, same shape', old_gather, preds)
+    bench('gather_variable, same shape', gather_variable, preds)
+    # uneven last batch
+    uneven = torch.randn(batch - 37 * rank, 1000)
+    out = bench('gather_variable, uneven batch', gather_variable, uneven)
+    assert out.shape[0] == sum(batch - 37 * r for r in range(world_size))
+    # many small leaves: one bucket per dtype instead of one all_gather per tensor
+    nested = {'logits': torch.randn(batch - rank, 2), 'labels': torch.randint(0, 2, (batch - rank,)),
+              'feats': [torch.randn(batch - rank, 16) for _ in range(8)], 'loss': torch.tensor(1.), 'name': f'rank{rank}'}
+    bench('gather_variable, nested (12 tensors)', gather_variable, nested)
+    bench('per-tensor all_gather_variable, nested', lambda d: [all_gather_variable(t) for t in
+                                                                 [d['logits'], d['labels'], d['loss']] + d['feats']], nested)
+    out = gather_variable(nested)
+    if rank == 0:
+        print({k: (v.shape if isinstance(v, torch.Tensor) else v) for k, v in out.items() if k != 'feats'})
+    dist.destroy_process_group()
+
+
+def _demo_metric_reducer(rank, world_size, port):
+    from .progress_utils import AverageMeter, WindowAverageMeter, EMAMeter
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    reducer = MetricReducer()
+    reducer['loss'] = torch.tensor(float(rank))
+    reducer['correct'] = torch.tensor([rank, 1])
+    reducer['lr'] = 0.1
+    reducer.reduce()
+    out = reducer.as_dict(to_float=True)
+    if rank == 0:
+        print('MetricReducer:', out)
+
+    meters = [AverageMeter('Loss', ':.3f'), WindowAverageMeter('Acc', ':.3f', window_size=2), EMAMeter('Time', ':.3f')]
+    for step in range(3):
+        for meter in meters:
+            meter.update(torch.tensor(float(rank + step)), n=rank + 1)
+    synced = reduce_meters(meters)
+    # the local meters are untouched, so a second call gives the same result
+    assert [str(meter) for meter in reduce_meters(meters)] == [str(meter) for meter in synced]
+    if rank == 0:
+        print('reduce_meters:', '  '.join(str(meter) for meter in synced))
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    import torch.multiprocessing as mp
+    mp.spawn(_demo_dist_metrics, args=(3, 29533), nprocs=3)
+    mp.spawn(_demo_metric_reducer, args=(3, 29535), nprocs=3)
+    mp.spawn(_bench_gather, args=(3, 29534), nprocs=3)
@@ -2,35 +2,57 @@ import os
 import pprint
 import random
 import string
+import json
+import sqlite3
+import functools
+import threading
+import importlib
+import multiprocessing
+import subprocess
+import tempfile
 import cv2
+import numpy as np
 from tqdm import tqdm
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait, as_completed
 
-from cypy.misc_utils import get_cmd_output, LazyImport, verbose_print, warn_print
+from cypy.misc_utils import run_cmd, _read_stream, parse_ffmpeg_progress, LazyImport, verbose_print, warn_print, timed
 from cypy.logging_utils import EasyLoggerManager
 from cypy.time_utils import Duration
+from cypy.file_utils import make_tmp_path, atomic_replace, safe_remove
 
 import ffmpeg
 import re
-import mmap
+import struct
 
 # avoid conflict with yt_pyvideoreader
 # from decord import VideoReader
 decord = LazyImport('decord')
+# PyAV is optional, only needed by the `av` probing backend
+av = LazyImport('av')
+
+DURATION_NORMAL = 'normal'  # normal videos with normal duration metadata
+DURATION_ABNORMAL = 'abnormal'  # abnormal videos with missing or broken duration metadata (not converted)
+DURATION_ABNORMAL_CONVERTED = 'abnormal_converted'  # abnormal videos converted successfully
+DURATION_ABNORMAL_CONVERTED_FAILED = 'abnormal_converted_failed'  # abnormal videos that cannot be converted
+
+
+# ffmpeg commands run with `run_cmd` (argv, no shell). `timeout` (seconds) args kill a hung ffmpeg, None waits forever.
+# Only the last lines of stderr are kept, the log of a long transcode can be huge.
+_ffmpeg_max_stderr_lines = 200
 
-# TODO: use ffmpeg to convert and detect is better in the future
-def detect_broken_duration_video(inp, dst_file_path=None, format='file', check_tool='ffmpeg', convert=False, convert_params=None, progress=True, verbose=False, logger=None):
-    assert format in ['file', 'list', 'txt'], 'format must be one of [file, list, txt], but got {}'.format(format)
-    assert check_tool in ['ffmpeg', 'decord'], 'check_tool must be one of `ffmpeg` or `decord`, but got `{}`'.format(check_tool)
-    if dst_file_path is not None:
-        assert format == 'file', "`format` can only be set to `file` when `dst_file_path` is specified"
-        dst_dir = os.path.dirname(dst_file_path)
-        if not os.path.exists(dst_dir):
-            try:
-                os.makedirs(dst_dir)
-            except Exception as e:
-                raise ValueError(f"create dir for {dst_file_path} failed! Exception: {str(e)}")
 
+def _params_to_argv(params):
+    # OrderedDict({'-c:v': 'libx264', '-an': ''}) -> ['-c:v', 'libx264', '-an']
+    argv = []
+    for k, v in params.items():
+        argv.append(str(k))
+        if v is not None and v != '':
+            argv.append(str(v))
+    return argv
+
+
+def _check_convert_params(convert_params):
     if convert_params is None:
         convert_params = {
             'global_params': OrderedDict({"-v": "error"}),
@@ -48,7 +70,177 @@ def detect_broken_duration_video(inp, dst_file_path=None, format='file', check_t
         for key, val in convert_params.items():
             assert key in ['global_params', 'input_params', 'output_params'], f'convert_params must be a dict with keys "global_params", "input_params", and "output_params", your key {key} is illegal'
             assert isinstance(val, OrderedDict), f'values of convert_params must be type of OrderedDict as the order in ffmpeg is important, however, the value of key {key} is type {type(val)}'
+    return convert_params
+
+
+def _check_broken_duration(video_path, check_tool='ffmpeg'):
+    # return True if the duration metadata of video_path is missing or broken
+    if check_tool == 'ffmpeg':
+        info = get_video_info(video_path, force_decoding=False)
+        return info.get('duration') in [-1, None]
+
+    try:
+        vr = decord.VideoReader(video_path)
+        img = vr[0].asnumpy()
+        h, w, c = img.shape
+        img = cv2.resize(img, (w//2, h//2))
+    except:
+        return True
+    return False
+
+
+def _has_valid_duration(video_path):
+    return os.path.exists(video_path) and os.path.getsize(video_path) > 0 and get_video_info(video_path).get('duration') not in [-1, None]
+
+
+def _remux_broken_duration_video(video_path, target_path, verbose=False, fsync='none', timeout=None):
+    # stream copy remux, the muxer rewrites the container header (duration included) without touching the codec data
+    # this takes seconds even for long videos, return True if the remuxed video has a valid duration
+    tmp_vid_file_name = make_tmp_path(target_path, tag='remux')
+    res = run_cmd(['ffmpeg', '-y', '-v', 'error', '-nostdin', '-i', video_path, '-c', 'copy', tmp_vid_file_name],
+                  timeout=timeout, max_stderr_lines=_ffmpeg_max_stderr_lines)
+    verbose_print(res.stderr, verbose)
+    if res.timed_out or not _has_valid_duration(tmp_vid_file_name):
+        safe_remove(tmp_vid_file_name)
+        return False
+    atomic_replace(tmp_vid_file_name, target_path, fsync=fsync)
+    return True
+
+
+def _convert_broken_duration_video(video_path, dst_file_path, convert_params, verbose=False, fsync='none', remux_first=True, timeout=None):
+    # try a stream copy remux first if `remux_first`, then fall back to re-encoding with convert_params
+    # the output is written to a unique tmp file next to the target, then atomically replaces dst_file_path (or video_path)
+    # return True if converted successfully
+    target_path = dst_file_path if dst_file_path is not None else video_path
+    if remux_first and _remux_broken_duration_video(video_path, target_path, verbose, fsync, timeout):
+        return True
+
+    tmp_vid_file_name = make_tmp_path(target_path)
+
+    cmd = ['ffmpeg', '-y', '-nostdin'] + _params_to_argv(convert_params.get('global_params', {})) + \
+          _params_to_argv(convert_params.get('input_params', {})) + ['-i', video_path] + \
+          _params_to_argv(convert_params.get('output_params', {})) + [tmp_vid_file_name]
+    res = run_cmd(cmd, timeout=timeout, max_stderr_lines=_ffmpeg_max_stderr_lines)
+    verbose_print(res.stderr, verbose)
+    if res.timed_out:
+        verbose_print(f'{video_path} converting timed out after {timeout} seconds.', verbose)
 
+    # e.g. a codec not allowed by the container may leave a header-only file behind
+    if res.timed_out or not _has_valid_duration(tmp_vid_file_name):
+        safe_remove(tmp_vid_file_name)
+        return False
+
+    atomic_replace(tmp_vid_file_name, target_path, fsync=fsync)
+    return True
+
+
+def iter_detect_broken_duration_video(video_paths, check_tool='ffmpeg', convert=False, convert_params=None, dst_file_path=None,
+                                      workers=8, convert_workers=None, pool_type='thread', max_pending=None, verbose=False, logger=None, fsync='none',
+                                      remux_first=True, timeout=None):
+    """Concurrent version of `detect_broken_duration_video`. Results are streamed as they complete.
+
+    Args:
+        video_paths (iterable):
+            Video paths to check. Can be a lazy iterable, only `max_pending` paths are read ahead.
+        check_tool, convert, convert_params, dst_file_path, verbose:
+            Same as `detect_broken_duration_video`. `dst_file_path` is a single output file, so it can only be given
+            with one video path, a ValueError is raised when a second path is read.
+        workers (int, optional):
+            Size of the checking pool. Defaults to 8.
+        convert_workers (int || None, optional):
+            Size of the converting pool. Conversions are heavy (re-encoding), so this pool is usually smaller.
+            If None, defaults to max(1, workers // 4).
+        pool_type (str, optional):
+            'thread' or 'process' for the checking pool. Checking with ffmpeg is subprocess-bound so 'thread' is enough,
+            'process' helps when check_tool is 'decord'. The converting pool is always thread-based since it only waits on ffmpeg.
+            Defaults to 'thread'.
+        max_pending (int || None, optional):
+            Max number of checking tasks in flight, bounds memory for huge path lists. If None, defaults to workers * 4.
+        logger (logging.Logger || None, optional):
+            If set, missing durations and failed conversions are logged.
+        fsync (str, optional):
+            fsync policy of the converted files, see `cypy.file_utils.atomic_replace`. Defaults to 'none'.
+        remux_first (bool, optional):
+            Try a stream copy remux before re-encoding, which fixes most missing durations in seconds. Defaults to True.
+        timeout (float || None, optional):
+            Seconds, a remux/conversion running longer is killed and counts as failed. Defaults to None (no timeout).
+
+    Yields:
+        (video_path, status): status is one of DURATION_NORMAL, DURATION_ABNORMAL, DURATION_ABNORMAL_CONVERTED,
+            DURATION_ABNORMAL_CONVERTED_FAILED. The order is the completion order, not the input order.
+    """
+    assert check_tool in ['ffmpeg', 'decord'], 'check_tool must be one of `ffmpeg` or `decord`, but got `{}`'.format(check_tool)
+    assert pool_type in ['thread', 'process'], 'pool_type must be one of `thread` or `process`, but got `{}`'.format(pool_type)
+    assert isinstance(workers, int) and workers > 0, f'workers must be int and > 0, but got {workers}'
+    if convert:
+        convert_params = _check_convert_params(convert_params)
+    if convert_workers is None:
+        convert_workers = max(1, workers // 4)
+    if max_pending is None:
+        max_pending = workers * 4
+
+    executor_cls = ThreadPoolExecutor if pool_type == 'thread' else ProcessPoolExecutor
+    video_paths = iter(video_paths)
+    check_futures = {}
+    convert_futures = {}
+    num_submitted = 0
+
+    with executor_cls(max_workers=workers) as check_pool, ThreadPoolExecutor(max_workers=convert_workers) as convert_pool:
+        def fill_check_pool():
+            nonlocal num_submitted
+            for video_path in video_paths:
+                if dst_file_path is not None and num_submitted >= 1:
+                    # all the conversions would be written to the same file
+                    raise ValueError('`dst_file_path` can only be specified with a single video path')
+                num_submitted += 1
+                assert os.path.exists(video_path), f'[{video_path}] does not exist'
+                check_futures[check_pool.submit(_check_broken_duration, video_path, check_tool)] = video_path
+                if len(check_futures) >= max_pending:
+                    break
+
+        fill_check_pool()
+        while check_futures or convert_futures:
+            done, _ = wait(list(check_futures) + list(convert_futures), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in check_futures:
+                    video_path = check_futures.pop(future)
+                    if not future.result():
+                        yield video_path, DURATION_NORMAL
+                        continue
+                    if logger is not None:
+                        logger.warning(f"{video_path} duration is missing.")
+                    if convert:
+                        convert_futures[convert_pool.submit(_convert_broken_duration_video, video_path, dst_file_path, convert_params, verbose, fsync, remux_first, timeout)] = video_path
+                    else:
+                        yield video_path, DURATION_ABNORMAL
+                else:
+                    video_path = convert_futures.pop(future)
+                    if future.result():
+                        yield video_path, DURATION_ABNORMAL_CONVERTED
+                    else:
+                        if logger is not None:
+                            logger.error(f'{video_path} duration is missing and converted by ffmpeg failed.')
+                        yield video_path, DURATION_ABNORMAL_CONVERTED_FAILED
+            fill_check_pool()
+
+
+# TODO: use ffmpeg to convert and detect is better in the future
+def detect_broken_duration_video(inp, dst_file_path=None, format='file', check_tool='ffmpeg', convert=False, convert_params=None, progress=True, verbose=False, logger=None,
+                                 workers=1, convert_workers=None, pool_type='thread', fsync='none', remux_first=True, timeout=None):
+    # if workers > 1, videos are checked (and converted) concurrently by `iter_detect_broken_duration_video`,
+    # and the output lists are in completion order instead of input order
+    assert format in ['file', 'list', 'txt'], 'format must be one of [file, list, txt], but got {}'.format(format)
+    assert check_tool in ['ffmpeg', 'decord'], 'check_tool must be one of `ffmpeg` or `decord`, but got `{}`'.format(check_tool)
+    if dst_file_path is not None:
+        assert format == 'file', "`format` can only be set to `file` when `dst_file_path` is specified"
+        dst_dir = os.path.dirname(dst_file_path)
+        if not os.path.exists(dst_dir):
+            try:
+                os.makedirs(dst_dir)
+            except Exception as e:
+                raise ValueError(f"create dir for {dst_file_path} failed! Exception: {str(e)}")
+
+    convert_params = _check_convert_params(convert_params)
 
     all_video_paths = []
     if format == 'file':
@@ -61,75 +253,136 @@ def detect_broken_duration_video(inp, dst_file_path=None, format='file', check_t
     else:
         all_video_paths = inp
 
-    random_route = ''.join(random.sample(string.ascii_letters + string.digits, 8))
-    tmp_vid_file_name = '/tmp/' + random_route + os.path.splitext(all_video_paths[0])[-1]
-    
     output_normal = []  # normal videos with normal duration metadata
     output_abnormal = []  # abnormal videos with missing or broken duration metadata
     output_abnormal_converted_failed = []  # abnormal videos with missing or broken duration metadata and cannot be converted
     if logger is None:
+        random_route = ''.join(random.sample(string.ascii_letters + string.digits, 8))
         logger = EasyLoggerManager(random_route).get_logger(log_to_console=True, stream_handler_color=True, formatter_template=None, handler_singleton=True)
 
+    if workers > 1:
+        results = iter_detect_broken_duration_video(all_video_paths, check_tool=check_tool, convert=convert, convert_params=convert_params,
+                                                    dst_file_path=dst_file_path, workers=workers, convert_workers=convert_workers,
+                                                    pool_type=pool_type, verbose=verbose, logger=logger, fsync=fsync,
+                                                    remux_first=remux_first, timeout=timeout)
+        if progress:
+            results = tqdm(results, total=len(all_video_paths))
+        for video_path, status in results:
+            if status == DURATION_NORMAL:
+                output_normal.append(video_path)
+            else:
+                output_abnormal.append(video_path)
+                if status == DURATION_ABNORMAL_CONVERTED_FAILED:
+                    output_abnormal_converted_failed.append(video_path)
+        return output_normal, output_abnormal, output_abnormal_converted_failed
+
     if progress:
         all_video_paths = tqdm(all_video_paths)
 
     for idx, video_path in enumerate(all_video_paths):
         assert os.path.exists(video_path), f'The {idx}th item [{video_path}] does not exist'
 
-        cur_abnormal_flag = False
-        if check_tool == 'ffmpeg':
-            info = get_video_info(video_path, force_decoding=False)
-            if info.get('duration') in [-1, None]:
-                cur_abnormal_flag = True
-        else:
-            try:
-                vr = decord.VideoReader(video_path)
-                img = vr[0].asnumpy()
-                h, w, c = img.shape
-                img = cv2.resize(img, (w//2, h//2))
-            except:
-                cur_abnormal_flag = True
+        cur_abnormal_flag = _check_broken_duration(video_path, check_tool)
         
         if cur_abnormal_flag:
             logger.warning(f"{video_path} duration is missing.")
             output_abnormal.append(video_path)
         
             if convert:
-                cmd1 = 'ffmpeg -y'
-                od = convert_params['global_params']
-                if od:
-                    cmd1 += ' ' + ' '.join(['{} {}'.format(k, v) for k, v in od.items()])
-                od = convert_params['input_params']
-                if od:
-                    cmd1 += ' ' + ' '.join(['{} {}'.format(k, v) for k, v in od.items()])
-                cmd1 += f' -i "{video_path}"'
-                od = convert_params['output_params']
-                if od:
-                    cmd1 += ' ' + ' '.join(['{} {}'.format(k, v) for k, v in od.items()])
-                cmd1 += f' {tmp_vid_file_name}'
-
-                stdout, stderr = get_cmd_output(cmd1)
-                verbose_print(stderr, verbose)
-                # print(cmd1)
-
-                if (not os.path.exists(tmp_vid_file_name)) or os.path.getsize(tmp_vid_file_name) == 0:
+                if not _convert_broken_duration_video(video_path, dst_file_path, convert_params, verbose, fsync, remux_first, timeout):
                     logger.error(f'{video_path} duration is missing and converted by ffmpeg failed.')
-                    get_cmd_output(f'rm -rf {tmp_vid_file_name}')
                     output_abnormal_converted_failed.append(video_path)
-                else:
-                    if dst_file_path is not None:
-                        cmd2 = f'mv {tmp_vid_file_name} "{dst_file_path}"'
-                    else:
-                        cmd2 = f'mv {tmp_vid_file_name} "{video_path}"'
-                    get_cmd_output(cmd2)
-                    # print(cmd2)
         else:
             output_normal.append(video_path)
 
     return output_normal, output_abnormal, output_abnormal_converted_failed
 
 
-def get_video_info(video_path, force_decoding=False, verbose=False):
+def _av_probe(video_path):
+    # in-process probing with PyAV, return a ffprobe-like dict (`ffprobe -show_format -show_streams -of json`)
+    # only the fields used by `get_video_info` are filled
+    with av.open(video_path) as container:
+        streams = []
+        for stream in container.streams:
+            codec_context = stream.codec_context
+            stream_dict = {'index': stream.index, 'codec_type': stream.type, 'codec_name': codec_context.name if codec_context is not None else 'none'}
+            if stream.type == 'video':
+                rate = stream.average_rate
+                stream_dict['avg_frame_rate'] = f'{rate.numerator}/{rate.denominator}' if rate else '0/0'
+                if stream.frames:
+                    stream_dict['nb_frames'] = str(stream.frames)
+                stream_dict['width'] = codec_context.width
+                stream_dict['height'] = codec_context.height
+                if stream.metadata:
+                    stream_dict['tags'] = dict(stream.metadata)
+            streams.append(stream_dict)
+
+        format_dict = {'filename': video_path, 'format_name': container.format.name}
+        if container.duration is not None:
+            format_dict['duration'] = f'{container.duration / av.time_base:.6f}'
+    return {'streams': streams, 'format': format_dict}
+
+
+def get_probe_backends():
+    # `ffprobe` is always listed, the real availability of the binary is checked at call time
+    backends = ['ffprobe']
+    if importlib.util.find_spec('av') is not None:
+        backends.append('av')
+    return backends
+
+
+def estimate_duration_from_packets(video_path, backend='ffprobe', timeout=None):
+    """Estimate (duration, nb_frames) of the first video stream from packet timestamps, by demuxing only (no decoding).
+    duration = max(pts + packet duration) - min(pts), nb_frames = number of video packets. (-1, -1) if no packet found.
+    """
+    pts_times, durations = [], []
+    if backend == 'av':
+        with av.open(video_path) as container:
+            stream = container.streams.video[0]
+            time_base = float(stream.time_base)
+            for packet in container.demux(stream):
+                # the last packet of demux is an empty flushing packet
+                if packet.pts is None:
+                    continue
+                pts_times.append(packet.pts * time_base)
+                durations.append(packet.duration * time_base if packet.duration else 0.)
+    else:
+        res = run_cmd(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_packets', '-show_entries', 'packet=pts_time,duration_time', '-of', 'json', video_path],
+                      timeout=timeout)
+        if res.timed_out:
+            raise TimeoutError(f'ffprobe show_packets timed out after {timeout} seconds')
+        for packet in json.loads(res.stdout).get('packets', []):
+            if packet.get('pts_time', 'N/A') == 'N/A':
+                continue
+            pts_times.append(float(packet['pts_time']))
+            durations.append(float(packet['duration_time']) if packet.get('duration_time', 'N/A') != 'N/A' else 0.)
+
+    if not pts_times:
+        return -1, -1
+    nb_frames = len(pts_times)
+    start_time, last_pts = min(pts_times), max(pts_times)
+    end_time = max(pts + duration for pts, duration in zip(pts_times, durations))
+    if end_time == last_pts and nb_frames > 1:
+        # packet durations are missing (e.g. WebM written to a pipe), use the average frame interval for the last frame
+        end_time += (last_pts - start_time) / (nb_frames - 1)
+    return end_time - start_time, nb_frames
+
+
+@timed('video.get_video_info')
+def get_video_info(video_path, force_decoding=False, verbose=False, cache=None, backend='ffprobe', decode_timeout=None):
+    # if `cache` (VideoProbeCache) is set, the result is looked up in / stored to the persistent probe cache.
+    #   `backend` and `decode_timeout` are only used to probe on a cache miss, both backends give the same info,
+    #   and results of a decoding that may have timed out are not stored
+    # force_decoding: how to measure the duration if it is missing in the container header
+    #   False: do not measure, duration is -1
+    #   True: decode the whole video with ffmpeg (slow, but exact)
+    #   'packets': estimate from packet timestamps by demuxing only (`ffprobe -show_packets` or PyAV, depends on `backend`)
+    # decode_timeout: seconds, kill the ffmpeg decoding process of `force_decoding` on timeout, the duration is then -1
+    # backend: `ffprobe` forks a ffprobe process per call, `av` probes in-process with PyAV (much cheaper for short clips)
+    assert backend in ['ffprobe', 'av'], f'backend must be one of `ffprobe` or `av`, but got `{backend}`'
+    assert force_decoding in [True, False, 'packets'], f'force_decoding must be one of True, False or `packets`, but got {force_decoding}'
+    if cache is not None:
+        return cache.get_video_info(video_path, force_decoding=force_decoding, verbose=verbose, backend=backend, decode_timeout=decode_timeout)
     assert os.path.exists(video_path), f'{video_path} does not exist'
 
     # contains: duration(float), nb_frames(int), fps(float), height(int), width(int), rotation(int), original_height(int), original_width(int), codec_name(str), missing_fields(list)
@@ -140,7 +393,10 @@ def get_video_info(video_path, force_decoding=False, verbose=False):
 
     # detailed ffprbe info reference: https://juejin.cn/post/6844903920750297101
     try:
-        probe = ffmpeg.probe(video_path)
+        if backend == 'av':
+            probe = _av_probe(video_path)
+        else:
+            probe = ffmpeg.probe(video_path)
         format = probe['format']
         video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
     except Exception as e:
@@ -172,20 +428,30 @@ def get_video_info(video_path, force_decoding=False, verbose=False):
     if duration == 0:
         info_dict['missing_fields'].append('duration')
         verbose_print(f'{video_path} has broken video duration. Container format is {format["format_name"]}, Codec is {video_stream["codec_name"]}')
-        if force_decoding:
-            _, err = get_cmd_output(f"ffmpeg -i {video_path} -f null -")
-            err = err.replace('\r', '\n')
+        if force_decoding == 'packets':
+            # demux only, much faster than decoding the whole video
+            try:
+                duration, nb_frames = estimate_duration_from_packets(video_path, backend=backend, timeout=decode_timeout)
+            except Exception as e:
+                verbose_print(f'{video_path} estimating duration from packets failed. Err: {str(e)}')
+                duration = -1
+            if duration > 0:
+                fps = nb_frames / duration
+            else:
+                duration = -1
+        elif force_decoding:
             # lines like: frame=  400 fps=0.0 q=-0.0 Lsize=N/A time=00:00:03.98 bitrate=N/A speed= 100x
-            info_line = [x for x in err.split('\n') if x.startswith('frame=')][-1].strip()
-            pattern = re.compile(r'(frame=)(.*)(fps.*time=)(.*)(bitrate.*)')
-            res = pattern.findall(info_line)[0]
-
-            duration_str = res[3].strip()
-            hour, miniute, second = [float(x) for x in duration_str.split(':')]
-            duration = hour * 3600 + miniute * 60 + second
-
-            nb_frames = int(res[1].strip())
-            fps = nb_frames / duration if duration >0 else 0.
+            # stderr is parsed while streaming and only the last progress is kept, the whole log of a long video can be huge
+            progress = {}
+            res = run_cmd(['ffmpeg', '-nostdin', '-i', video_path, '-f', 'null', '-'], timeout=decode_timeout, max_stderr_lines=16,
+                          stderr_callback=lambda line: progress.update(parse_ffmpeg_progress(line) or {}))
+            if res.timed_out or 'time' not in progress or 'frame' not in progress:
+                verbose_print(f'{video_path} force decoding failed (timed out: {res.timed_out}).')
+                duration = -1
+            else:
+                duration = progress['time']
+                nb_frames = progress['frame']
+                fps = nb_frames / duration if duration >0 else 0.
         else:
             duration = -1
     else:
@@ -222,9 +488,559 @@ def get_video_info(video_path, force_decoding=False, verbose=False):
     return info_dict
 
 
-def ffmpeg_cut_video(src_video_path, dst_video_path, start_time, end_time=None, duration=None, accurate_cut=True):
+def _probe_worker(args):
+    video_path, force_decoding, backend = args
+    try:
+        return get_video_info(video_path, force_decoding=force_decoding, backend=backend)
+    except Exception:
+        # keep the same semantics as an unparsable video, one bad path should not break the whole batch
+        return {'missing_fields': []}
+
+
+def _probe_worker_with_path(args):
+    return args[0], _probe_worker(args)
+
+
+class VideoProber(object):
+    """
+    Bulk probing engine with the same output schema as `get_video_info`.
+
+    backend:
+        'av': probe in-process with PyAV, no process creation at all.
+        'ffprobe': fork a ffprobe process per video, same as `get_video_info`.
+        'auto': 'av' if PyAV is installed, otherwise 'ffprobe'.
+    workers:
+        If > 0, a pool of long-lived worker processes is created once (lazily) and reused by all later calls,
+        so the interpreter, imported modules and PyAV are initialized only once per worker.
+        If 0, probing runs in the calling process.
+
+    e.g.:
+    with VideoProber(backend='auto', workers=8) as prober:
+        infos = prober.batch_probe(video_paths)
+        for video_path, info in prober.iter_probe(video_paths, ordered=False):
+            ...
+    """
+
+    def __init__(self, backend='auto', workers=0, chunksize=16, force_decoding=False):
+        assert backend in ['auto', 'ffprobe', 'av'], f'backend must be one of `auto`, `ffprobe` or `av`, but got `{backend}`'
+        if backend == 'auto':
+            backend = 'av' if 'av' in get_probe_backends() else 'ffprobe'
+        elif backend == 'av':
+            assert 'av' in get_probe_backends(), 'backend `av` requires PyAV, try `pip install av`'
+        self.backend = backend
+        self.workers = workers
+        self.chunksize = chunksize
+        self.force_decoding = force_decoding
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None and self.workers > 0:
+            self._pool = multiprocessing.Pool(self.workers)
+        return self._pool
+
+    def probe(self, video_path):
+        return get_video_info(video_path, force_decoding=self.force_decoding, backend=self.backend)
+
+    def iter_probe(self, video_paths, ordered=True):
+        # yield (video_path, info), in input order if `ordered`, otherwise in completion order
+        tasks = [(video_path, self.force_decoding, self.backend) for video_path in video_paths]
+        if self.pool is None:
+            results = map(_probe_worker, tasks)
+            for task, info in zip(tasks, results):
+                yield task[0], info
+        elif ordered:
+            for task, info in zip(tasks, self.pool.imap(_probe_worker, tasks, chunksize=self.chunksize)):
+                yield task[0], info
+        else:
+            # carry the path with the result since the order is lost
+            for video_path, info in self.pool.imap_unordered(_probe_worker_with_path, tasks, chunksize=self.chunksize):
+                yield video_path, info
+
+    def batch_probe(self, video_paths):
+        # return info dicts in the same order as video_paths
+        return [info for _, info in self.iter_probe(video_paths, ordered=True)]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class VideoProbeCache(object):
+    """
+    Persistent on-disk cache of `get_video_info` results, backed by SQLite so that it can be shared by
+    many processes and jobs. An entry is keyed by (abs path, force_decoding) and is only valid if the file size and
+    mtime (ns) still match, so modified files are re-probed automatically.
+
+    e.g.:
+    cache = VideoProbeCache('probe_cache.sqlite')
+    info = cache.get_video_info('a.mp4')  # or get_video_info('a.mp4', cache=cache)
+    infos = cache.batch_get_video_info(video_paths, workers=8)  # one SQL query per chunk, misses are probed concurrently
+    cache.warm_up(video_paths)  # or `python -m cypy.video_utils --probe_cache probe_cache.sqlite --warm_up list.txt`
+    cache.invalidate(['a.mp4'])
+    cache.prune()  # remove entries whose files are removed or modified
+
+    NOTE: failed probes (empty info dict) are not cached, since they may be caused by transient errors.
+    """
+
+    # SQLite limits the number of host parameters in a single query
+    _chunk_size = 500
+
+    def __init__(self, db_path, timeout=60):
+        self.db_path = db_path
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=timeout, check_same_thread=False)
+        # WAL allows concurrent readers with one writer across processes
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS probe_cache ('
+                           'path TEXT NOT NULL, force_decoding INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+                           'info TEXT NOT NULL, PRIMARY KEY (path, force_decoding))')
+        self._conn.commit()
+
+    @staticmethod
+    def _force_decoding_key(force_decoding):
+        # stored as an int column: False -> 0, True -> 1, 'packets' -> 2
+        return 2 if force_decoding == 'packets' else int(force_decoding)
+
+    @staticmethod
+    def _stat_key(video_path):
+        st = os.stat(video_path)
+        return os.path.abspath(video_path), st.st_size, st.st_mtime_ns
+
+    def _lookup(self, keys, force_decoding):
+        # keys: list of (abs_path, size, mtime_ns), return {abs_path: info}
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), self._chunk_size):
+                chunk = keys[i: i + self._chunk_size]
+                placeholders = ','.join(['?'] * len(chunk))
+                rows = self._conn.execute(f'SELECT path, size, mtime_ns, info FROM probe_cache WHERE force_decoding = ? AND path IN ({placeholders})',
+                                          [self._force_decoding_key(force_decoding)] + [k[0] for k in chunk]).fetchall()
+                found.update({row[0]: row[1:] for row in rows})
+
+        ret = {}
+        for path, size, mtime_ns in keys:
+            row = found.get(path)
+            if row is not None and row[0] == size and row[1] == mtime_ns:
+                ret[path] = json.loads(row[2])
+        return ret
+
+    def _store(self, items, force_decoding, decode_timeout=None):
+        # items: list of ((abs_path, size, mtime_ns), info)
+        # a failed force decoding with a timeout may be a timeout of a slow/busy machine, so it is not stored either
+        skip_failed_decoding = force_decoding and decode_timeout is not None
+        rows = [(key[0], self._force_decoding_key(force_decoding), key[1], key[2], json.dumps(info)) for key, info in items
+                if info.get('duration') is not None and not (skip_failed_decoding and info['duration'] == -1)]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO probe_cache (path, force_decoding, size, mtime_ns, info) VALUES (?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+
+    def get(self, video_path, force_decoding=False):
+        # return the cached info dict, or None if not cached or out of date
+        key = self._stat_key(video_path)
+        return self._lookup([key], force_decoding).get(key[0])
+
+    def get_video_info(self, video_path, force_decoding=False, verbose=False, backend='ffprobe', decode_timeout=None):
+        # backend and decode_timeout only apply to the probing of a miss, see `get_video_info`
+        assert os.path.exists(video_path), f'{video_path} does not exist'
+        key = self._stat_key(video_path)
+        info = self._lookup([key], force_decoding).get(key[0])
+        if info is None:
+            info = get_video_info(video_path, force_decoding=force_decoding, verbose=verbose, backend=backend, decode_timeout=decode_timeout)
+            self._store([(key, info)], force_decoding, decode_timeout)
+        return info
+
+    def batch_get_video_info(self, video_paths, force_decoding=False, verbose=False, workers=1, progress=False, backend='ffprobe', decode_timeout=None):
+        # return info dicts in the same order as video_paths, misses are probed (concurrently if workers > 1) and stored in bulk
+        keys = []
+        for video_path in video_paths:
+            assert os.path.exists(video_path), f'{video_path} does not exist'
+            keys.append(self._stat_key(video_path))
+        cached = self._lookup(keys, force_decoding)
+
+        miss_idxs = [i for i, key in enumerate(keys) if key[0] not in cached]
+        miss_paths = [video_paths[i] for i in miss_idxs]
+        probe_func = functools.partial(get_video_info, force_decoding=force_decoding, verbose=verbose, backend=backend, decode_timeout=decode_timeout)
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                miss_infos = pool.map(probe_func, miss_paths)
+                if progress:
+                    miss_infos = tqdm(miss_infos, total=len(miss_paths))
+                miss_infos = list(miss_infos)
+        else:
+            miss_infos = [probe_func(x) for x in (tqdm(miss_paths) if progress else miss_paths)]
+        self._store([(keys[i], info) for i, info in zip(miss_idxs, miss_infos)], force_decoding, decode_timeout)
+
+        miss_dict = dict(zip(miss_idxs, miss_infos))
+        return [cached[key[0]] if key[0] in cached else miss_dict[i] for i, key in enumerate(keys)]
+
+    def warm_up(self, video_paths, force_decoding=False, workers=8, progress=True, chunk_size=10000):
+        # probe and store all uncached videos, return the number of newly probed videos
+        # videos are processed in chunks so that results are persisted progressively for huge lists
+        video_paths = [x for x in video_paths if os.path.exists(x)]
+        n_probed = 0
+        for i in range(0, len(video_paths), chunk_size):
+            chunk = video_paths[i: i + chunk_size]
+            n_probed += len(chunk) - len(self._lookup([self._stat_key(x) for x in chunk], force_decoding))
+            self.batch_get_video_info(chunk, force_decoding=force_decoding, workers=workers, progress=progress)
+        return n_probed
+
+    def invalidate(self, video_paths=None):
+        # remove entries of video_paths, or all entries if video_paths is None
+        with self._lock:
+            if video_paths is None:
+                self._conn.execute('DELETE FROM probe_cache')
+            else:
+                paths = [os.path.abspath(x) for x in video_paths]
+                for i in range(0, len(paths), self._chunk_size):
+                    chunk = paths[i: i + self._chunk_size]
+                    placeholders = ','.join(['?'] * len(chunk))
+                    self._conn.execute(f'DELETE FROM probe_cache WHERE path IN ({placeholders})', chunk)
+            self._conn.commit()
+
+    def prune(self):
+        # remove entries whose files no longer exist or have been modified, return the number of removed entries
+        with self._lock:
+            rows = self._conn.execute('SELECT path, force_decoding, size, mtime_ns FROM probe_cache').fetchall()
+        stale = []
+        for path, force_decoding, size, mtime_ns in rows:
+            try:
+                st = os.stat(path)
+                if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                    stale.append((path, force_decoding))
+            except OSError:
+                stale.append((path, force_decoding))
+        with self._lock:
+            self._conn.executemany('DELETE FROM probe_cache WHERE path = ? AND force_decoding = ?', stale)
+            self._conn.commit()
+        return len(stale)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM probe_cache').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _ffmpeg_iter_frames(video_path, fps, indices, size, pix_fmt, num_buffers, info):
+    channels = {'rgb24': 3, 'bgr24': 3, 'gray': 1}[pix_fmt]
+    if size is None:
+        # ffmpeg auto-rotates, so the rotated size is the output size
+        size = (info['width'], info['height'])
+    width, height = size
+
+    # sampling and scaling are done inside ffmpeg, python only copies the final frames out of the pipe
+    # a select expression of too many indices exceeds the argv limit, then frames are filtered while reading the pipe
+    select_in_pipe = indices is not None and len(indices) > 1000
+    filters = []
+    if fps is not None:
+        filters.append(f'fps={fps}')
+    elif indices is not None and not select_in_pipe:
+        filters.append('select=' + '+'.join([f'eq(n\\,{i})' for i in indices]))
+    filters.append(f'scale={width}:{height}')
+
+    cmd = ['ffmpeg', '-v', 'error', '-nostdin', '-i', video_path, '-vf', ','.join(filters)]
+    if indices is not None:
+        # keep the selected frames only, do not duplicate/drop to match the input frame rate
+        cmd += ['-fps_mode', 'passthrough']
+    cmd += ['-f', 'rawvideo', '-pix_fmt', pix_fmt, '-']
+
+    frame_shape = (height, width, channels) if channels > 1 else (height, width)
+    frame_bytes = width * height * channels
+    buffer = np.empty((num_buffers, ) + frame_shape, dtype=np.uint8)
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=frame_bytes)
+    # stderr is drained in a thread (only the last lines are kept), otherwise a corrupt input logging more than
+    # the pipe capacity blocks ffmpeg, while we block on stdout
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=_read_stream, args=(process.stderr, stderr_chunks, None, _ffmpeg_max_stderr_lines), daemon=True)
+    stderr_reader.start()
+    try:
+        frame_idx = 0
+        decoded_idx = -1
+        indices_set = set(indices) if select_in_pipe else None
+        while True:
+            frame = buffer[frame_idx % num_buffers]
+            view = memoryview(frame).cast('B')
+            n_read = 0
+            while n_read < frame_bytes:
+                n = process.stdout.readinto(view[n_read:])
+                if not n:
+                    break
+                n_read += n
+            if n_read < frame_bytes:
+                break
+            decoded_idx += 1
+            if select_in_pipe:
+                if decoded_idx > indices[-1]:
+                    break
+                if decoded_idx not in indices_set:
+                    continue
+            yield frame
+            frame_idx += 1
+
+        process.stdout.close()
+        returncode = process.wait()
+        stderr_reader.join()
+        if returncode != 0 and frame_idx == 0:
+            stderr = b''.join(stderr_chunks).decode('utf-8', errors='ignore').strip()
+            raise RuntimeError(f'ffmpeg decoding {video_path} failed: {stderr}')
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        stderr_reader.join()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def _decord_iter_frames(video_path, fps, indices, size, pix_fmt, batch_size):
+    assert pix_fmt in ['rgb24', 'gray'], f'decord backend only supports pix_fmt `rgb24` or `gray`, but got `{pix_fmt}`'
+    # decord scales inside the decoder when width/height are given
+    width, height = size if size is not None else (-1, -1)
+    vr = decord.VideoReader(video_path, width=width, height=height)
+    num_frames = len(vr)
+    if fps is not None:
+        indices = np.arange(0, num_frames, vr.get_avg_fps() / fps).astype(np.int64)
+    elif indices is None:
+        indices = np.arange(num_frames)
+    indices = [i for i in indices if i < num_frames]
+
+    for i in range(0, len(indices), batch_size):
+        batch = vr.get_batch(indices[i: i + batch_size]).asnumpy()
+        if pix_fmt == 'gray':
+            batch = np.stack([cv2.cvtColor(x, cv2.COLOR_RGB2GRAY) for x in batch])
+        for frame in batch:
+            yield frame
+
+
+def iter_frames(video_path, fps=None, indices=None, size=None, backend='ffmpeg', pix_fmt='rgb24', num_buffers=2, batch_size=16):
+    """Decode frames of a video lazily with bounded memory.
+
+    Args:
+        video_path (str):
+            Video path.
+        fps (float || None, optional):
+            If set, sample frames at this frame rate. Cannot be used together with `indices`.
+            Defaults to None.
+        indices (list || np.ndarray || None, optional):
+            If set, only decode frames at these (0-based) indices. Frames are yielded in ascending index order.
+            Defaults to None, which means all frames.
+        size (tuple || None, optional):
+            Output (width, height). Scaling is done inside the decoder. If None, keep the original (rotated) size.
+            Defaults to None.
+        backend (str, optional):
+            'ffmpeg': decode through a ffmpeg rawvideo pipe. Frames are written into a preallocated buffer of `num_buffers`
+                frames which is reused, so a yielded frame is only valid until `num_buffers - 1` more frames are yielded.
+                Copy it if you need to keep it.
+            'decord': decode with decord.VideoReader by batches of `batch_size` frames.
+            Defaults to 'ffmpeg'.
+        pix_fmt (str, optional):
+            'rgb24', 'bgr24' (ffmpeg only) or 'gray'. Defaults to 'rgb24'.
+
+    Yields:
+        np.ndarray: uint8 frame of shape (height, width, 3) or (height, width) for gray.
+    """
+    assert os.path.exists(video_path), f'{video_path} does not exist'
+    assert backend in ['ffmpeg', 'decord'], f'backend must be one of `ffmpeg` or `decord`, but got `{backend}`'
+    assert pix_fmt in ['rgb24', 'bgr24', 'gray'], f'pix_fmt must be one of `rgb24`, `bgr24` or `gray`, but got `{pix_fmt}`'
+    if fps is not None and indices is not None:
+        raise ValueError('Only one of fps or indices can be specified')
+    if indices is not None:
+        indices = sorted(set(int(i) for i in indices))
+        if not indices:
+            return
+    assert isinstance(num_buffers, int) and num_buffers > 0, f'num_buffers must be int and > 0, but got {num_buffers}'
+
+    if backend == 'decord':
+        yield from _decord_iter_frames(video_path, fps, indices, size, pix_fmt, batch_size)
+        return
+
+    info = None
+    if size is None:
+        info = get_video_info(video_path)
+        if info.get('width') is None:
+            raise ValueError(f'{video_path} is not a valid video file, failed to get its size')
+    yield from _ffmpeg_iter_frames(video_path, fps, indices, size, pix_fmt, num_buffers, info)
+
+
+def get_keyframe_times(video_path):
+    """Return the sorted pts times (seconds) of the keyframes of the first video stream, read from `ffprobe -show_packets`
+    without decoding. The result is cached in memory, keyed by (abs path, size, mtime), so repeated cuts of the same
+    video only demux it once.
+    """
+    assert os.path.exists(video_path), f'{video_path} does not exist'
+    return [pts_time for pts_time, _ in _get_keyframe_index(video_path)]
+
+
+def _get_keyframe_index(video_path):
+    # return sorted (pts_time, packet index in decode order) of keyframes
+    st = os.stat(video_path)
+    return _get_keyframe_index_cached(os.path.abspath(video_path), st.st_size, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_keyframe_index_cached(video_path, size, mtime_ns):
+    # size and mtime_ns are only used as cache keys
+    res = run_cmd(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_packets', '-show_entries', 'packet=pts_time,flags', '-of', 'json', video_path])
+    try:
+        packets = json.loads(res.stdout).get('packets', [])
+    except Exception:
+        raise ValueError(f'{video_path} ffprobe show_packets failed: {res.stderr}')
+    # packets are listed in decode order
+    keyframe_index = [(float(x['pts_time']), i) for i, x in enumerate(packets) if 'K' in x.get('flags', '') and x.get('pts_time', 'N/A') != 'N/A']
+    return tuple(sorted(keyframe_index))
+
+
+# encoders to re-encode the partial GOPs in smart cut, and the encoder profile names of the ffprobe profiles.
+# The stream copied part keeps the parameter sets (SPS/PPS) of the source, while mp4 (avcC/hvcC) only stores the ones
+# of the first part, so the re-encoded parts must use the same profile and level as the source to be decodable.
+_smart_cut_encoders = {
+    'h264': ('libx264', {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main', 'High': 'high',
+                         'High 10': 'high10', 'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444'}),
+    'hevc': ('libx265', {'Main': 'main', 'Main 10': 'main10', 'Main Still Picture': 'mainstillpicture'}),
+}
+
+
+def _smart_cut_encode_params(video_stream):
+    # ffmpeg output params to re-encode with the profile and level of `video_stream`, None if they are unknown
+    codec_name = video_stream['codec_name']
+    encoder, profiles = _smart_cut_encoders[codec_name]
+    profile = profiles.get(video_stream.get('profile'))
+    level = video_stream.get('level')
+    if profile is None or level is None or int(level) <= 0:
+        return None
+    params = ['-an', '-c:v', encoder, '-profile:v', profile]
+    if codec_name == 'h264':
+        # level_idc is level * 10, e.g. 31 -> 3.1
+        params += ['-level:v', f'{int(level) / 10:.1f}']
+    else:
+        # general_level_idc is level * 30, e.g. 93 -> 3.1, libx265 only takes it from x265-params
+        params += ['-x265-params', f'log-level=error:level-idc={int(level) / 30:.1f}']
+    if video_stream.get('pix_fmt'):
+        params += ['-pix_fmt', video_stream['pix_fmt']]
+    return params
+
+
+def _smart_cut_video(src_video_path, dst_video_path, start_time, duration, verbose=False, timeout=None):
+    # re-encode [start, first keyframe) and [last keyframe, end), stream copy the GOPs in between
+    # return False if smart cut is not applicable, then the caller should fall back to an accurate cut
+    end_time = start_time + duration
+    try:
+        probe = ffmpeg.probe(src_video_path)
+        video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+        keyframe_index = _get_keyframe_index(src_video_path)
+    except Exception as e:
+        verbose_print(f'{src_video_path} smart cut probing failed, fallback to accurate cut. Err: {str(e)}', verbose)
+        return False
+    if video_stream is None or video_stream['codec_name'] not in _smart_cut_encoders:
+        verbose_print(f'{src_video_path} smart cut is not supported for this codec, fallback to accurate cut.', verbose)
+        return False
+    encode_params = _smart_cut_encode_params(video_stream)
+    if encode_params is None:
+        verbose_print(f'{src_video_path} smart cut is not supported for profile {video_stream.get("profile")} '
+                      f'level {video_stream.get("level")}, fallback to accurate cut.', verbose)
+        return False
+
+    inner_keyframes = [x for x in keyframe_index if start_time <= x[0] < end_time]
+    if len(inner_keyframes) < 2:
+        # not a single full GOP inside, nothing to copy
+        return False
+    (copy_start, copy_start_idx), (copy_end, copy_end_idx) = inner_keyframes[0], inner_keyframes[-1]
+
+    # keep the precision of keyframe times, Duration only keeps 2 digits.
+    # 1e-4 s (far less than one frame) is added so that the input seeking never snaps to the previous keyframe
+    # each part is (ffmpeg params, re-encoded or not)
+    parts = []
+    if copy_start > start_time:
+        parts.append((['-ss', str(Duration(start_time)), '-i', src_video_path, '-t', f'{copy_start - start_time:.6f}'] + encode_params, True))
+    # the copied part is bounded by packet count instead of `-t`, since with B-frames `-t` lets a few packets
+    # of the next GOP in (packets are cut in decode order), which would duplicate frames of the tail part
+    parts.append((['-ss', f'{copy_start + 1e-4:.6f}', '-i', src_video_path, '-frames:v', str(copy_end_idx - copy_start_idx), '-an', '-c:v', 'copy'], False))
+    if end_time > copy_end:
+        parts.append((['-ss', f'{copy_end + 1e-4:.6f}', '-i', src_video_path, '-t', f'{end_time - copy_end:.6f}'] + encode_params, True))
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(dst_video_path))) as tmp_dir:
+        part_paths = []
+        for i, (part_params, encoded) in enumerate(parts):
+            part_path = os.path.join(tmp_dir, f'part_{i}.ts')
+            res = run_cmd(['ffmpeg', '-y', '-v', 'error'] + part_params + [part_path], timeout=timeout, max_stderr_lines=_ffmpeg_max_stderr_lines)
+            verbose_print(res.stderr, verbose)
+            if res.timed_out or (not os.path.exists(part_path)) or os.path.getsize(part_path) == 0:
+                verbose_print(f'{src_video_path} smart cut part {i} failed, fallback to accurate cut.', verbose)
+                return False
+            if encoded and not _smart_cut_part_matches(part_path, video_stream):
+                verbose_print(f'{src_video_path} smart cut part {i} does not match the source stream parameters, fallback to accurate cut.', verbose)
+                return False
+            part_paths.append(part_path)
+
+        list_path = os.path.join(tmp_dir, 'parts.txt')
+        with open(list_path, 'w') as f:
+            for part_path in part_paths:
+                f.write(f"file '{part_path}'\n")
+        # audio is cheap to re-encode, so it is cut accurately from the source in one go
+        res = run_cmd(['ffmpeg', '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                       '-ss', str(Duration(start_time)), '-i', src_video_path, '-t', f'{duration:.6f}',
+                       '-map', '0:v', '-map', '1:a?', '-c:v', 'copy', dst_video_path], timeout=timeout, max_stderr_lines=_ffmpeg_max_stderr_lines)
+        verbose_print(res.stderr, verbose)
+        if res.timed_out:
+            safe_remove(dst_video_path)
+            return False
+
+    return os.path.exists(dst_video_path) and os.path.getsize(dst_video_path) > 0
+
+
+def _smart_cut_part_matches(part_path, video_stream):
+    # the fields of the SPS that ffprobe exposes, a mismatch means the parts can not share the parameter sets
+    keys = ['codec_name', 'profile', 'level', 'width', 'height', 'pix_fmt']
+    try:
+        part_stream = next(stream for stream in ffmpeg.probe(part_path)['streams'] if stream['codec_type'] == 'video')
+    except Exception:
+        return False
+    _, profiles = _smart_cut_encoders[video_stream['codec_name']]
+    for key in keys:
+        part_value, src_value = part_stream.get(key), video_stream.get(key)
+        if key == 'profile':
+            # e.g. x264 baseline is reported as Constrained Baseline
+            part_value, src_value = profiles.get(part_value), profiles.get(src_value)
+        if part_value != src_value:
+            return False
+    return True
+
+
+def ffmpeg_cut_video(src_video_path, dst_video_path, start_time, end_time=None, duration=None, accurate_cut=True, verbose=False, timeout=None):
     # start_time, end_time, duration must be seconds(float)
+    # timeout: seconds, ffmpeg is killed on timeout, the partial output is removed and TimeoutError is raised
+    # accurate_cut:
+    #   True: re-encode the whole segment, frame accurate
+    #   False: stream copy, the start snaps to keyframes
+    #   'smart': only re-encode the partial GOPs at the head and tail, stream copy the rest (h264/hevc only),
+    #            frame accurate at close to stream copy speed. Fall back to True if not applicable.
     assert os.path.exists(src_video_path), f'{src_video_path} does not exist'
+    assert accurate_cut in [True, False, 'smart'], f'accurate_cut must be one of True, False or `smart`, but got {accurate_cut}'
 
     if end_time is None and duration is None:
         raise ValueError('Either end_time or duration must be specified')
@@ -234,69 +1050,279 @@ def ffmpeg_cut_video(src_video_path, dst_video_path, start_time, end_time=None,
     if end_time is not None:
         assert end_time > start_time, f'end_time({end_time}) must be greater than start_time({start_time})'
         duration = end_time - start_time
-    
-    cut_cmd = f'ffmpeg -y -ss {Duration(start_time)} -i "{src_video_path}" -t {Duration(duration)} -c copy "{dst_video_path}"'
-    if accurate_cut:
-        cut_cmd = f'ffmpeg -y -ss {Duration(start_time)} -i "{src_video_path}" -t {Duration(duration)} "{dst_video_path}"'
 
-    get_cmd_output(cut_cmd)
+    if accurate_cut == 'smart':
+        if _smart_cut_video(src_video_path, dst_video_path, start_time, duration, verbose, timeout):
+            return
+        accurate_cut = True
+
+    cut_cmd = ['ffmpeg', '-y', '-ss', str(Duration(start_time)), '-i', src_video_path, '-t', str(Duration(duration))]
+    if not accurate_cut:
+        cut_cmd += ['-c', 'copy']
+    res = run_cmd(cut_cmd + [dst_video_path], timeout=timeout, max_stderr_lines=_ffmpeg_max_stderr_lines)
+    verbose_print(res.stderr, verbose)
+    if res.timed_out:
+        safe_remove(dst_video_path)
+        raise TimeoutError(f'{src_video_path} cutting timed out after {timeout} seconds')
+
+
+def cut_video_segments(src_video_path, segments, accurate_cut=True, max_outputs_per_pass=32, verbose=False, timeout=None):
+    """Cut many segments from one source video in one ffmpeg process (one decode shared by many outputs when re-encoding).
+
+    Args:
+        src_video_path (str):
+            Source video path.
+        segments (list):
+            List of (start_time, end_time, dst_video_path), times are seconds(float). Segments may overlap.
+        accurate_cut (bool, optional):
+            Same meaning as in `ffmpeg_cut_video` (except 'smart'), each output is the same as the one of
+            `ffmpeg_cut_video`. If False, each output gets its own input seeking of the source (demuxing only).
+            Defaults to True.
+        max_outputs_per_pass (int, optional):
+            Max number of outputs of one ffmpeg process. With re-encoding, each output owns an encoder,
+            so this bounds the memory usage. Defaults to 32.
+        timeout (float || None, optional):
+            Seconds per ffmpeg process (one per `max_outputs_per_pass` segments). On timeout, all the outputs of the
+            process count as failed. Defaults to None (no timeout).
+
+    Returns:
+        list: success flag (bool) of each segment, in the same order as `segments`. Failed outputs are removed.
+    """
+    assert os.path.exists(src_video_path), f'{src_video_path} does not exist'
+    assert isinstance(max_outputs_per_pass, int) and max_outputs_per_pass > 0, f'max_outputs_per_pass must be int and > 0, but got {max_outputs_per_pass}'
+    for start_time, end_time, _ in segments:
+        assert end_time > start_time, f'end_time({end_time}) must be greater than start_time({start_time})'
+
+    # sort by start time, so that each pass seeks as far as possible
+    order = sorted(range(len(segments)), key=lambda i: segments[i][0])
+    success = [False] * len(segments)
+    for i in range(0, len(order), max_outputs_per_pass):
+        chunk = [segments[j] for j in order[i: i + max_outputs_per_pass]]
+        for _, _, dst_video_path in chunk:
+            # remove stale outputs, so that the existence check below is reliable
+            if os.path.exists(dst_video_path):
+                os.remove(dst_video_path)
+
+        if accurate_cut:
+            # fast input seeking to the earliest start, the decoder output is then shared by all outputs,
+            # which are cut accurately by output seeking
+            seek_time = chunk[0][0]
+            cut_cmd = ['ffmpeg', '-y', '-ss', str(Duration(seek_time)), '-i', src_video_path]
+            for start_time, end_time, dst_video_path in chunk:
+                if start_time > seek_time:
+                    cut_cmd += ['-ss', str(Duration(start_time - seek_time))]
+                cut_cmd += ['-t', str(Duration(end_time - start_time)), dst_video_path]
+        else:
+            # output seeking of a stream copy drops the keyframe a segment starts on (with B-frames), so each output
+            # reads its own input with input seeking to the previous keyframe, the same as `ffmpeg_cut_video`.
+            # Demuxing is cheap, there is nothing to share without decoding.
+            cut_cmd = ['ffmpeg', '-y']
+            for start_time, _, _ in chunk:
+                cut_cmd += ['-ss', str(Duration(start_time)), '-i', src_video_path]
+            for k, (start_time, end_time, dst_video_path) in enumerate(chunk):
+                cut_cmd += ['-map', f'{k}:v:0', '-map', f'{k}:a:0?', '-t', str(Duration(end_time - start_time)), '-c', 'copy', dst_video_path]
+
+        res = run_cmd(cut_cmd, timeout=timeout, max_stderr_lines=_ffmpeg_max_stderr_lines)
+        verbose_print(res.stderr, verbose)
+        if res.timed_out:
+            verbose_print(f'{src_video_path} cutting timed out after {timeout} seconds.', verbose)
+
+        # ffmpeg still writes an output without any video frame, e.g. a stream copy segment without any keyframe inside,
+        # which only holds the audio if the source has audio. So each output is probed instead of checking the size.
+        for j in order[i: i + max_outputs_per_pass]:
+            # outputs of a killed process may be truncated
+            success[j] = (not res.timed_out) and _has_video_content(segments[j][2])
+            if not success[j]:
+                safe_remove(segments[j][2])
+    return success
+
+
+def _has_video_content(video_path):
+    # True if the file has a video stream with a positive duration
+    if (not os.path.exists(video_path)) or os.path.getsize(video_path) == 0:
+        return False
+    try:
+        probe = ffmpeg.probe(video_path)
+    except Exception:
+        return False
+    video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+    if video_stream is None:
+        return False
+    # stream duration may be missing (e.g. mkv/webm), then the container duration is used
+    duration = video_stream.get('duration', probe['format'].get('duration', 'N/A'))
+    try:
+        return float(duration) > 0
+    except ValueError:
+        return False
+
+
+def iter_cut_video_segments(tasks, accurate_cut=True, workers=4, max_outputs_per_pass=32, verbose=False, timeout=None):
+    """Cut segments from many source videos concurrently, each source video is handled by `cut_video_segments`.
+
+    Args:
+        tasks (iterable):
+            Iterable of (src_video_path, segments), see `cut_video_segments` for the format of segments.
+        workers (int, optional):
+            Number of source videos processed at the same time. Defaults to 4.
+        timeout (float || None, optional):
+            Seconds per ffmpeg process, see `cut_video_segments`. Defaults to None.
+
+    Yields:
+        (src_video_path, success): success is the list of per-segment flags. The order is the completion order.
+    """
+    assert isinstance(workers, int) and workers > 0, f'workers must be int and > 0, but got {workers}'
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(cut_video_segments, src_video_path, segments, accurate_cut, max_outputs_per_pass, verbose, timeout): (src_video_path, segments)
+                   for src_video_path, segments in tasks}
+        for future in as_completed(futures):
+            src_video_path, segments = futures[future]
+            try:
+                success = future.result()
+            except Exception as e:
+                verbose_print(f'{src_video_path} cut failed. Err: {str(e)}', verbose)
+                success = [False] * len(segments)
+            yield src_video_path, success
+
+
+
+# ISO-BMFF (mp4/mov) box walker, only box headers and the few boxes needed are read, `mdat` is skipped by seeking
+# ref: ISO/IEC 14496-12, https://developer.apple.com/documentation/quicktime-file-format
+_mp4_container_boxes = {b'moov', b'trak', b'mdia'}
 
+# display matrix (a, b, u, c, d, v, x, y, w) of clockwise rotations, a/b/c/d/x/y are 16.16 fixed, u/v/w are 2.30 fixed
+_mp4_rotation_matrices = {
+    0: (0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000),
+    90: (0, 0x10000, 0, -0x10000, 0, 0, 0, 0, 0x40000000),
+    180: (-0x10000, 0, 0, 0, -0x10000, 0, 0, 0, 0x40000000),
+    270: (0, -0x10000, 0, 0x10000, 0, 0, 0, 0, 0x40000000),
+}
 
-def rotate_video(video_path, angle, verbose=False):
+
+def _iter_mp4_boxes(f, start, end):
+    # yield (box_type, box_start, payload_start, box_end) of the boxes in [start, end)
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack('>I4s', header)
+        payload_start = offset + 8
+        if size == 1:
+            # 64-bit largesize
+            size = struct.unpack('>Q', f.read(8))[0]
+            payload_start += 8
+        elif size == 0:
+            # box extends to the end of its container (or the file)
+            size = end - offset
+        if size < payload_start - offset:
+            raise ValueError(f'broken box {box_type} at {offset} with size {size}')
+        yield box_type, offset, payload_start, min(offset + size, end)
+        offset += size
+
+
+def _mp4_matrix_to_angle(matrix):
+    # the translation (x, y) is ignored, return None if not a pure clockwise rotation of 0/90/180/270
+    for angle, rotation_matrix in _mp4_rotation_matrices.items():
+        if matrix[:6] == rotation_matrix[:6] and matrix[8] == rotation_matrix[8]:
+            return angle
+    return None
+
+
+def find_mp4_video_tracks(video_path):
+    """Walk the boxes of a mp4/mov file and return [(matrix_offset, matrix), ...] of the `tkhd` of each video track,
+    matrix_offset is the absolute file offset of the 36 bytes display matrix, matrix is the 9 int values.
+    Only box headers, `tkhd` and `hdlr` are read, so the cost does not depend on the file size.
+    """
+    tracks = []
+    with open(video_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+
+        def walk(start, end, trak_info):
+            for box_type, box_start, payload_start, box_end in _iter_mp4_boxes(f, start, end):
+                if box_type == b'trak':
+                    info = {}
+                    walk(payload_start, box_end, info)
+                    if info.get('handler_type') == b'vide' and 'matrix_offset' in info:
+                        tracks.append((info['matrix_offset'], info['matrix']))
+                elif box_type in _mp4_container_boxes:
+                    walk(payload_start, box_end, trak_info)
+                elif box_type == b'tkhd' and trak_info is not None:
+                    f.seek(payload_start)
+                    version = f.read(1)[0]
+                    # version(1) flags(3), times/track_ID/reserved/duration (20 or 32), reserved(8), layer/alternate_group/volume/reserved(8)
+                    matrix_offset = payload_start + 4 + (32 if version == 1 else 20) + 16
+                    if matrix_offset + 36 > box_end:
+                        raise ValueError(f'broken tkhd box at {box_start}')
+                    f.seek(matrix_offset)
+                    trak_info['matrix_offset'] = matrix_offset
+                    trak_info['matrix'] = struct.unpack('>9i', f.read(36))
+                elif box_type == b'hdlr' and trak_info is not None:
+                    # version(1) flags(3) pre_defined(4) handler_type(4)
+                    f.seek(payload_start + 8)
+                    trak_info['handler_type'] = f.read(4)
+
+        walk(0, file_size, None)
+    return tracks
+
+
+def get_mp4_rotation(video_path):
+    # return the clockwise rotation angle of the first video track read from `tkhd`, None if not found or not a pure rotation
+    tracks = find_mp4_video_tracks(video_path)
+    if not tracks:
+        return None
+    return _mp4_matrix_to_angle(tracks[0][1])
+
+
+def batch_rotate_video(video_paths, angles, workers=4, verbose=False, fsync='none', timeout=None):
+    # rotate many videos concurrently, `angles` is an int for all videos or a list with one angle per video
+    # return a list of rotate_video results (INPLACE_SUCCESS, REPLACE_SUCCESS, new_video_path) in the same order
+    if isinstance(angles, int):
+        angles = [angles] * len(video_paths)
+    assert len(angles) == len(video_paths), f'len(angles)({len(angles)}) must be equal to len(video_paths)({len(video_paths)})'
+    func = functools.partial(rotate_video, verbose=verbose, fsync=fsync, timeout=timeout)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(func, video_paths, angles))
+    return [func(video_path, angle) for video_path, angle in zip(video_paths, angles)]
+
+
+def rotate_video(video_path, angle, verbose=False, fsync='none', timeout=None):
     # rotate video by angle, angle is in degree and clockwise
+    # timeout: seconds, only for the ffmpeg fallback, which counts as failed on timeout
     assert os.path.exists(video_path), f'{video_path} does not exist'
     assert isinstance(angle, int) and angle % 90 == 0, f'angle must be a multiple of 90, but got {angle}'
 
     angle = angle % 360
 
-    # lossless rotate is achieved by modifying the metadata in place
+    # lossless rotate is achieved by modifying the display matrix of moov/trak/tkhd of each video track in place
     # ref: https://superuser.com/a/1307206/1010278, https://gist.github.com/hajoscher/2b77247ed714207ba59d6b13c1371000
-    # but this only supports part mp4 container formats
+    # but this only supports mp4/mov (ISO-BMFF) container formats
     # fallback method is using ffmpeg modifying metadata, but it leads to lossy rotatation with re-encoding 
     # ref: https://ostechnix.com/how-to-rotate-videos-using-ffmpeg-from-commandline/
     # moreover, the fallback methods does not support generate avi and mkv outputs (change it to mp4 is ok)
 
-    # inplace modify metadata hex code
-    zero = bytes([0,   1,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,
-                  0,   1,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0, 
-                  64])
-
-    r90  = bytes([0,   0,   0,   0,   0,   1,   0,   0,   0,   0,   0,   0, 255, 255,   0,   0,
-                  0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0, 
-                  64])
-
-    r180 = bytes([255, 255,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,
-                  255, 255,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,
-                  64])
-
-    r270 = bytes([0,   0,   0,   0, 255, 255,   0,   0,   0,   0,   0,   0,   0,   1,   0,   0,
-                  0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,
-                  64]) 
-    
-    angle_d = {0: zero, 90: r90, 180: r180, 270: r270}
-
     INPLACE_SUCCESS = False
-    with open(video_path, "r+b") as f:
-        mm = mmap.mmap(f.fileno(), 0)
-        loc = mm.find(b'vide')
-        if loc < 160:
-            verbose_print(f'{video_path} does not support inplace modify metadata, first try failed (hex loc1 not found).', verbose)
+    try:
+        tracks = find_mp4_video_tracks(video_path)
+    except Exception as e:
+        tracks = []
+        verbose_print(f'{video_path} does not support inplace modify metadata, parsing mp4 boxes failed. Err: {str(e)}', verbose)
+
+    if not tracks:
+        verbose_print(f'{video_path} does not support inplace modify metadata, no video track (moov/trak/tkhd) found.', verbose)
+    else:
+        original_angles = [_mp4_matrix_to_angle(matrix) for _, matrix in tracks]
+        if None in original_angles:
+            verbose_print(f'{video_path} does not support inplace modify metadata, original angle not found (matrix is not a pure rotation).', verbose)
         else:
-            mm.seek(loc - 160)
-            loc = mm.find(bytes([64])) - 32
-            if loc < 0:
-                verbose_print(f'{video_path} does not support inplace modify metadata, second try failed (hex loc2 not found).', verbose)
-            else:
-                mm.seek(loc)
-                original_angle_hex = mm.read(33)
-                if original_angle_hex in list(angle_d.values()):
-                    verbose_print(f'{video_path} found original angle {list(angle_d.values()).index(original_angle_hex) * 90} in metadata, and will be changed to {angle} in place.', verbose)
-                    mm.seek(loc)
-                    mm.write(angle_d[angle])
-                    INPLACE_SUCCESS = True
-                else:
-                    verbose_print(f'{video_path} does not support inplace modify metadata, third try failed (original angle not found).', verbose)
-        mm.close()
+            verbose_print(f'{video_path} found original angle {original_angles} in metadata, and will be changed to {angle} in place.', verbose)
+            matrix_bytes = struct.pack('>9i', *_mp4_rotation_matrices[angle])
+            with open(video_path, 'r+b') as f:
+                for matrix_offset, _ in tracks:
+                    f.seek(matrix_offset)
+                    f.write(matrix_bytes)
+            INPLACE_SUCCESS = True
 
     REPLACE_SUCCESS = False
     if not INPLACE_SUCCESS:
@@ -317,16 +1343,37 @@ def rotate_video(video_path, angle, verbose=False):
             return INPLACE_SUCCESS, REPLACE_SUCCESS, video_path
 
         try:
-            tmp_video_path = f'/tmp/{video_prefix}_{random.randint(0, 1e6)}{new_video_suffix}'
+            # the tmp file is next to the target, so the replacement is a rename instead of a cross-device copy
+            tmp_video_path = make_tmp_path(new_video_path)
             # add minus symbol to use clockwise rotation
-            cmd = f'ffmpeg -y -i "{video_path}" -c copy -metadata:s:v:0 rotate=-{angle} "{tmp_video_path}"'
-            get_cmd_output(cmd)
-            cmd = f'mv "{tmp_video_path}" "{new_video_path}"'
-            get_cmd_output(cmd)
-            REPLACE_SUCCESS = True
+            res = run_cmd(['ffmpeg', '-y', '-nostdin', '-i', video_path, '-c', 'copy', '-metadata:s:v:0', f'rotate=-{angle}', tmp_video_path],
+                          timeout=timeout, max_stderr_lines=_ffmpeg_max_stderr_lines)
+            verbose_print(res.stderr, verbose)
+            if (not res.timed_out) and os.path.exists(tmp_video_path) and os.path.getsize(tmp_video_path) > 0:
+                atomic_replace(tmp_video_path, new_video_path, fsync=fsync)
+                REPLACE_SUCCESS = True
+            else:
+                safe_remove(tmp_video_path)
+                verbose_print(f'{video_path} rotate by ffmpeg failed.')
         except Exception as e:
             verbose_print(f'{video_path} rotate by ffmpeg failed. Err: {str(e)}')
     
         return INPLACE_SUCCESS, REPLACE_SUCCESS, new_video_path
     else:
-        return INPLACE_SUCCESS, REPLACE_SUCCESS, video_path
\ No newline at end of file
+        return INPLACE_SUCCESS, REPLACE_SUCCESS, video_path
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Warm up the persistent video probe cache.')
+    parser.add_argument('--probe_cache', type=str, required=True, help='path of the sqlite probe cache')
+    parser.add_argument('--warm_up', type=str, required=True, help='txt file with one video path per line')
+    parser.add_argument('--force_decoding', type=lambda x: 'packets' if str(x).lower() == 'packets' else (str(x).lower() == 'true'), default=False)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    with open(args.warm_up, 'r') as f:
+        video_paths = [line.strip() for line in f if line.strip()]
+    with VideoProbeCache(args.probe_cache) as cache:
+        n_probed = cache.warm_up(video_paths, force_decoding=args.force_decoding, workers=args.workers)
+        print(f'{n_probed} videos probed, {len(cache)} entries in {args.probe_cache}')